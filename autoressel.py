@@ -6,9 +6,11 @@ if TYPE_CHECKING:
 
 import os
 import json
+import sqlite3
 import logging
 import re
 import requests
+from requests.adapters import HTTPAdapter
 import threading
 import queue
 import concurrent.futures
@@ -18,6 +20,13 @@ from FunPayAPI.updater.events import NewOrderEvent, NewMessageEvent
 import time
 import uuid
 import hashlib
+import bisect
+import heapq
+import itertools
+import collections
+import contextlib
+import copy
+import types as pytypes
 
 try:
     import pymysql
@@ -37,6 +46,13 @@ logger = logging.getLogger("FPC.telegramaccounts")
 CONFIG_DIR = "storage/tg"
 CONFIG_PATH = f"{CONFIG_DIR}/config.json"
 USER_ORDERS_PATH = f"{CONFIG_DIR}/user_orders.json"
+ORDERS_DB_PATH = f"{CONFIG_DIR}/orders.db"
+PROFIT_LEDGER_PATH = f"{CONFIG_DIR}/profit_ledger.jsonl"
+ORDER_JOURNAL_PATH = f"{CONFIG_DIR}/order_journal.jsonl"
+
+LZT_API_BASE = "https://prod-api.lzt.market"
+LZT_POOL_SIZE = 10
+LZT_REQUEST_TIMEOUT = 30
 
 DEFAULT_PURCHASE_TEMPLATE = """Спасибо за покупку!
 
@@ -51,16 +67,107 @@ DEFAULT_CODE_TEMPLATE = """✅ Код для входа в Telegram: {code}
 
 Также не забудьте оставить отзыв!"""
 
+# Лимиты запросов к LZT Market по классам эндпоинтов: запросов в минуту и размер всплеска
+DEFAULT_RATE_LIMITS = {
+    "search": {"per_minute": 20, "burst": 2},
+    "fast_buy": {"per_minute": 30, "burst": 3},
+    "login_code": {"per_minute": 30, "burst": 3},
+    "item": {"per_minute": 60, "burst": 5},
+    "history": {"per_minute": 20, "burst": 1}
+}
+
+DEFAULT_PREVALIDATE_COUNT = 5
+# Пул проверок создаётся по prevalidate_count, чтобы все проверки шли параллельно, но не больше этого числа
+PREVALIDATE_MAX_WORKERS = 16
+
+CODE_POLL_MAX_ATTEMPTS = 10
+CODE_POLL_RETRY_DELAY = 3
+CODE_POLL_WORKERS = 3
+CODE_CACHE_TTL = 30
+CODE_REQUEST_WORKERS = 4
+CODE_REQUEST_MAX_PER_BUYER = 2
+
+ADMIN_CHAT_INTERVAL = 1.0
+ADMIN_GLOBAL_INTERVAL = 1 / 30
+ADMIN_DIGEST_WINDOW = 60
+ADMIN_DIGEST_MAX_LINES = 30
+
+BUYER_DELIVERY_MAX_ATTEMPTS = 5
+BUYER_DELIVERY_RETRY_DELAY = 2
+BUYER_OUTBOX_DRAIN_TIMEOUT = 15
+
+JOURNAL_GROUP_COMMIT_WINDOW = 0.005
+JOURNAL_COMPACT_THRESHOLD = 200
+JOURNAL_RETRY_DELAY = 1
+JOURNAL_APPEND_TIMEOUT = 5
+
+# Отметки о ходе заказа в order_states: по ним повтор из журнала не покупает второй аккаунт
+ORDER_STATE_BUYING = "buying"
+ORDER_STATE_PURCHASED = "purchased"
+ORDER_STATE_REFUNDED = "refunded"
+
+SELLS_INDEX_TTL = 60
+SELLS_INDEX_MAX_PAGES = 5
+SELLS_INDEX_BUILD_TIMEOUT = 30
+
+IMPORT_PAGE_DELAY = 2
+IMPORT_HISTORY_MAX_PAGES = 20
+LZT_TELEGRAM_CATEGORY_ID = 24
+
+DEFAULT_PREFETCH_INTERVAL = 60
+DEFAULT_PREFETCH_MAX_AGE = 120
+# Сколько стран прогреваются одним поисковым запросом с несколькими country[]
+DEFAULT_PREFETCH_BATCH_SIZE = 10
+
+# Границы числа заказов в работе: диспетчер подстраивает лимит под задержки и ошибки LZT Market (AIMD)
+CONCURRENCY_HARD_LIMIT = 20
+DEFAULT_CONCURRENCY_MIN = 1
+DEFAULT_CONCURRENCY_MAX = 6
+INITIAL_CONCURRENCY = 3
+CONCURRENCY_INCREASE_INTERVAL = 5
+CONCURRENCY_DECREASE_COOLDOWN = 10
+CONCURRENCY_LATENCY_FACTOR = 2.0
+# Лимит подстраивается только по запросам, которые делают сами заказы, а не фоновые задачи
+CONCURRENCY_FEEDBACK_ENDPOINTS = ("search", "fast_buy")
+
+# Очередь заказов делится на полосы по странам; заказ старше QUEUE_STARVATION_AGE берётся вне очереди,
+# а одна полоса не занимает больше QUEUE_LANE_MAX_SHARE лимита, пока ждут заказы других стран
+QUEUE_PRIORITY_MODES = ("fair", "value", "age")
+QUEUE_PRIORITY_NAMES = {"fair": "по очереди", "value": "по сумме", "age": "по возрасту"}
+QUEUE_STARVATION_AGE = 30
+QUEUE_LANE_MAX_SHARE = 0.5
+
+LZT_BREAKER_FAILURE_THRESHOLD = 5
+LZT_BREAKER_OPEN_TIMEOUT = 30
+LZT_BREAKER_MAX_OPEN_TIMEOUT = 300
+
+CONFIG_SAVE_DEBOUNCE = 0.5
+
+METRICS_PATH = f"{CONFIG_DIR}/metrics.prom"
+METRICS_WINDOW = 1000
+METRICS_EXPORT_INTERVAL = 30
+
 used_orders = {}
 order_account_ids = {}
 order_phone_numbers = {}
-order_queue = queue.Queue()
+order_dispatcher = None
 executor = None
-max_workers = 5
-active_tasks = 0
-max_concurrent_tasks = 3
-task_lock = threading.Lock()
-is_processing = False
+order_store = None
+profit_ledger = None
+order_index = None
+sells_index = None
+code_poller = None
+validation_executor = None
+country_index = None
+admin_notifier = None
+buyer_outbox = None
+order_journal = None
+lzt_client = None
+lzt_rate_limiter = None
+lzt_breaker = None
+sells_importer = None
+code_request_scheduler = None
+inventory_cache = None
 
 ORIGIN_MAP = {
     "phishing": "Фишинг",
@@ -74,6 +181,37 @@ ORIGIN_MAP = {
 bot = None
 cardinal_instance = None
 config = {}
+config_store = None
+
+
+def get_dispatcher_stats_text():
+    """Строка с состоянием очереди заказов для главного меню"""
+    if not order_dispatcher:
+        return "📦 Очередь заказов: не запущена"
+
+    stats = order_dispatcher.get_stats()
+    return (
+        f"📦 Очередь заказов: {stats['queue_depth']}, в работе: {stats['in_flight']}/{stats['limit']}, "
+        f"ожидание: {stats['avg_wait']:.2f} сек. (макс. {stats['max_wait']:.2f})\n"
+        f"⚙️ Параллельность: {stats['limit']} (границы {stats['min_limit']}-{stats['max_limit']})\n"
+        f"{get_lanes_text(stats['lanes'])}"
+        f"{get_lzt_status_text(stats['held'])}"
+    )
+
+
+def get_lanes_text(lanes):
+    """Строка с очередями по странам, пустая, если заказов в очереди нет"""
+    if not lanes:
+        return ""
+    parts = [f"{lane or 'без страны'}: {size}" for lane, size in sorted(lanes.items())]
+    return f"🛣 По странам: {', '.join(parts)}\n"
+
+
+def get_lzt_status_text(held):
+    """Строка с состоянием автомата защиты LZT Market"""
+    if lzt_breaker and lzt_breaker.state != CircuitBreaker.CLOSED:
+        return f"🔌 LZT Market: недоступен, отложено заказов: {held}"
+    return f"🔌 LZT Market: доступен" + (f", отложено заказов: {held}" if held else "")
 
 
 def show_tg_settings(message: types.Message):
@@ -87,7 +225,7 @@ def show_tg_settings(message: types.Message):
         InlineKeyboardButton("📋 Заказы", callback_data="tg_orders"),
         InlineKeyboardButton("🔍 Фильтры", callback_data="tg_origin"),
         InlineKeyboardButton("💬 Шаблоны", callback_data="tg_message_templates"),
-        InlineKeyboardButton("⚙️ soon...", callback_data="tg_setup_plugin")
+        InlineKeyboardButton("⚙️ Настройки", callback_data="tg_setup_plugin")
     )
 
     countries_count = len(config["countries"])
@@ -99,7 +237,8 @@ def show_tg_settings(message: types.Message):
         f"👨‍💻 <b>Автор:</b> {CREDITS}\n\n"
         f"📊 <b>Статистика:</b>\n"
         f"🌍 Количество стран: {countries_count}\n"
-        f"👥 Количество администраторов: {admins_count}\n\n"
+        f"👥 Количество администраторов: {admins_count}\n"
+        f"{get_dispatcher_stats_text()}\n\n"
         f"⚙️ <b>Настройки автовыдачи телеграмм номеров:</b>"
     )
 
@@ -118,7 +257,7 @@ def show_tg_settings_callback(call: types.CallbackQuery):
         InlineKeyboardButton("📋 Заказы", callback_data="tg_orders"),
         InlineKeyboardButton("🔍 Фильтры", callback_data="tg_origin"),
         InlineKeyboardButton("💬 Шаблоны", callback_data="tg_message_templates"),
-        InlineKeyboardButton("⚙️ soon...", callback_data="tg_setup_plugin")
+        InlineKeyboardButton("⚙️ Настройки", callback_data="tg_setup_plugin")
     )
 
     countries_count = len(config["countries"])
@@ -130,7 +269,8 @@ def show_tg_settings_callback(call: types.CallbackQuery):
         f"👨‍💻 <b>Автор:</b> {CREDITS}\n\n"
         f"📊 <b>Статистика:</b>\n"
         f"🌍 Количество стран: {countries_count}\n"
-        f"👥 Количество администраторов: {admins_count}\n\n"
+        f"👥 Количество администраторов: {admins_count}\n"
+        f"{get_dispatcher_stats_text()}\n\n"
         f"⚙️ <b>Настройки автовыдачи телеграмм номеров:</b>"
     )
 
@@ -157,10 +297,18 @@ def ensure_config_exists():
             "origins": ["personal"],
             "purchase_template": DEFAULT_PURCHASE_TEMPLATE,
             "code_template": DEFAULT_CODE_TEMPLATE,
-            "orders_profit": {}
+            "rate_limits": copy.deepcopy(DEFAULT_RATE_LIMITS),
+            "prefetch_enabled": True,
+            "prefetch_interval": DEFAULT_PREFETCH_INTERVAL,
+            "prefetch_max_age": DEFAULT_PREFETCH_MAX_AGE,
+            "prefetch_batch_size": DEFAULT_PREFETCH_BATCH_SIZE,
+            "prevalidate_count": DEFAULT_PREVALIDATE_COUNT,
+            "concurrency_min": DEFAULT_CONCURRENCY_MIN,
+            "concurrency_max": DEFAULT_CONCURRENCY_MAX,
+            "hold_on_lzt_outage": False,
+            "queue_priority": "fair"
         }
-        with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
-            json.dump(default_config, f, ensure_ascii=False, indent=4)
+        write_json_atomic(CONFIG_PATH, default_config)
         return default_config
 
     with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
@@ -171,9 +319,6 @@ def ensure_config_exists():
             config_data["origins"] = [config_data["origin"]]
             del config_data["origin"]
 
-            with open(CONFIG_PATH, 'w', encoding='utf-8') as f_write:
-                json.dump(config_data, f_write, ensure_ascii=False, indent=4)
-
         if "origins" not in config_data:
             logger.info(f"{LOGGER_PREFIX} Добавление поля origins по умолчанию")
             config_data["origins"] = ["personal"]
@@ -186,63 +331,361 @@ def ensure_config_exists():
             logger.info(f"{LOGGER_PREFIX} Добавление шаблона сообщения выдачи кода по умолчанию")
             config_data["code_template"] = DEFAULT_CODE_TEMPLATE
 
-        if "orders_profit" not in config_data:
-            logger.info(f"{LOGGER_PREFIX} Добавление хранилища данных о прибыли от заказов")
-            config_data["orders_profit"] = {}
+        if "rate_limits" not in config_data:
+            logger.info(f"{LOGGER_PREFIX} Добавление лимитов запросов к LZT Market по умолчанию")
+            config_data["rate_limits"] = copy.deepcopy(DEFAULT_RATE_LIMITS)
+
+        if "prefetch_enabled" not in config_data:
+            logger.info(f"{LOGGER_PREFIX} Добавление настроек предзагрузки аккаунтов по умолчанию")
+            config_data["prefetch_enabled"] = True
+            config_data["prefetch_interval"] = DEFAULT_PREFETCH_INTERVAL
+            config_data["prefetch_max_age"] = DEFAULT_PREFETCH_MAX_AGE
+
+        if "prefetch_batch_size" not in config_data:
+            logger.info(f"{LOGGER_PREFIX} Добавление размера пакетного поиска для предзагрузки по умолчанию")
+            config_data["prefetch_batch_size"] = DEFAULT_PREFETCH_BATCH_SIZE
+
+        if "prevalidate_count" not in config_data:
+            logger.info(f"{LOGGER_PREFIX} Добавление настройки предварительной проверки аккаунтов по умолчанию")
+            config_data["prevalidate_count"] = DEFAULT_PREVALIDATE_COUNT
+
+        if "concurrency_min" not in config_data:
+            logger.info(f"{LOGGER_PREFIX} Добавление границ параллельной обработки заказов по умолчанию")
+            config_data["concurrency_min"] = DEFAULT_CONCURRENCY_MIN
+            config_data["concurrency_max"] = DEFAULT_CONCURRENCY_MAX
+
+        if "hold_on_lzt_outage" not in config_data:
+            logger.info(f"{LOGGER_PREFIX} Добавление настройки удержания заказов при недоступности LZT Market")
+            config_data["hold_on_lzt_outage"] = False
+
+        if "queue_priority" not in config_data:
+            logger.info(f"{LOGGER_PREFIX} Добавление режима приоритета очереди заказов по умолчанию")
+            config_data["queue_priority"] = "fair"
+
+    write_json_atomic(CONFIG_PATH, config_data)
+    return config_data
+
+
+class OrderStore:
+    """Хранилище заказов пользователей (user→orders, phone→user) на SQLite в режиме WAL"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS orders ("
+                "order_id TEXT PRIMARY KEY, user_id TEXT NOT NULL, phone TEXT, item_id INTEGER, created_at TEXT)"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS phone_users (phone TEXT PRIMARY KEY, user_id TEXT NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS order_states ("
+                "order_id TEXT PRIMARY KEY, state TEXT NOT NULL, item_id INTEGER, phone TEXT, updated_at TEXT, "
+                "cost REAL)"
+            )
+            # Стоимость аккаунта нужна для учёта прибыли при выдаче после перезапуска
+            state_columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(order_states)")}
+            if "cost" not in state_columns:
+                self._conn.execute("ALTER TABLE order_states ADD COLUMN cost REAL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_phone ON orders (phone)")
+
+    def migrate_from_json(self, json_path):
+        """Одноразовый перенос данных из user_orders.json"""
+        if self.get_meta("json_migrated") or not os.path.exists(json_path):
+            return
+
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка при чтении {json_path} для миграции: {e}")
+            return
+
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        orders_rows = [
+            (str(order_id), str(user_id), order_data.get("phone"), order_data.get("item_id"), now)
+            for user_id, orders in data.get("user_orders", {}).items()
+            for order_id, order_data in orders.items()
+        ]
+        phone_rows = [(str(phone), str(user_id)) for phone, user_id in data.get("phone_users", {}).items()]
 
-        with open(CONFIG_PATH, 'w', encoding='utf-8') as f_write:
-            json.dump(config_data, f_write, ensure_ascii=False, indent=4)
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR IGNORE INTO orders VALUES (?, ?, ?, ?, ?)", orders_rows)
+            self._conn.executemany("INSERT OR IGNORE INTO phone_users VALUES (?, ?)", phone_rows)
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('json_migrated', ?)", (now,))
 
-        return config_data
+        os.replace(json_path, f"{json_path}.migrated")
+        logger.info(
+            f"{LOGGER_PREFIX} Перенесено {len(orders_rows)} заказов и {len(phone_rows)} номеров из {json_path} в SQLite")
+
+    def add_order(self, user_id, order_id, phone, item_id, replace=True):
+        """
+        Сохраняет заказ и привязку номера к покупателю. Возвращает True, если запись добавлена.
+        Привязка номера обновляется и тогда, когда при replace=False заказ уже был сохранён.
+        """
+        user_id, order_id = str(user_id), str(order_id)
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                f"{verb} INTO orders VALUES (?, ?, ?, ?, ?)",
+                (order_id, user_id, phone, item_id, time.strftime("%Y-%m-%d %H:%M:%S"))
+            )
+            inserted = cursor.rowcount > 0
+            if phone:
+                self._conn.execute("INSERT OR REPLACE INTO phone_users VALUES (?, ?)", (phone, user_id))
+        return inserted
+
+    def get_order(self, order_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM orders WHERE order_id = ?", (str(order_id),)).fetchone()
+        return dict(row) if row else None
+
+    def get_user_orders(self, user_id):
+        """Заказы покупателя в виде {order_id: {"phone", "item_id"}}"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT order_id, phone, item_id FROM orders WHERE user_id = ?", (str(user_id),)
+            ).fetchall()
+        return {row["order_id"]: {"phone": row["phone"], "item_id": row["item_id"]} for row in rows}
+
+    def find_user_order_by_phone(self, user_id, phone):
+        """Заказ покупателя с указанным номером: (order_id, item_id) или None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT order_id, item_id FROM orders WHERE user_id = ? AND phone = ? LIMIT 1",
+                (str(user_id), phone)
+            ).fetchone()
+        return (row["order_id"], row["item_id"]) if row else None
+
+    def get_phone_owner(self, phone):
+        with self._lock:
+            row = self._conn.execute("SELECT user_id FROM phone_users WHERE phone = ?", (phone,)).fetchone()
+        return row["user_id"] if row else None
+
+    def get_all_orders(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM orders").fetchall()
+        return [dict(row) for row in rows]
+
+    def get_incomplete_orders(self):
+        """Заказы, у которых не хватает номера или ID лота"""
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM orders WHERE phone IS NULL OR item_id IS NULL").fetchall()
+        return [dict(row) for row in rows]
+
+    def update_binding(self, order_id, phone, item_id):
+        """Дополняет недостающие номер и ID лота, уже сохранённые значения не меняются"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE orders SET phone = COALESCE(phone, ?), item_id = COALESCE(item_id, ?) WHERE order_id = ?",
+                (phone, item_id, str(order_id))
+            )
+            row = self._conn.execute("SELECT user_id FROM orders WHERE order_id = ?", (str(order_id),)).fetchone()
+            if row and phone:
+                self._conn.execute("INSERT OR IGNORE INTO phone_users VALUES (?, ?)", (phone, row["user_id"]))
+
+    def set_order_state(self, order_id, state, item_id=None, phone=None, cost=None):
+        """Отметка о покупке или возврате, записывается до выдачи номера покупателю"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO order_states (order_id, state, item_id, phone, updated_at, cost) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (str(order_id), state, item_id, phone, time.strftime("%Y-%m-%d %H:%M:%S"), cost)
+            )
 
+    def get_order_state(self, order_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM order_states WHERE order_id = ?", (str(order_id),)).fetchone()
+        return dict(row) if row else None
 
-def load_user_orders():
-    """Загрузка данных о заказах пользователей"""
-    if not os.path.exists(USER_ORDERS_PATH):
-        user_orders_data = {
-            "user_orders": {},
-            "phone_users": {}
-        }
-        with open(USER_ORDERS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(user_orders_data, f, ensure_ascii=False, indent=4)
-        return user_orders_data
+    def clear_order_state(self, order_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM order_states WHERE order_id = ?", (str(order_id),))
 
-    try:
-        with open(USER_ORDERS_PATH, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"{LOGGER_PREFIX} Ошибка при загрузке данных о заказах пользователей: {e}")
-        return {"user_orders": {}, "phone_users": {}}
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else default
 
+    def set_meta(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
 
-def save_user_orders(data):
-    """Сохранение данных о заказах пользователей"""
-    try:
-        with open(USER_ORDERS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        return True
-    except Exception as e:
-        logger.error(f"{LOGGER_PREFIX} Ошибка при сохранении данных о заказах пользователей: {e}")
-        return False
+    def close(self):
+        with self._lock:
+            self._conn.close()
 
 
-def save_config():
-    """Сохранение конфигурации в файл"""
-    with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
-        json.dump(config, f, ensure_ascii=False, indent=4)
+def write_json_atomic(path, data):
+    """Запись JSON через временный файл и os.replace: при сбое остаётся прежняя версия файла"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def freeze_config(value):
+    """Неизменяемая копия конфигурации: словари - MappingProxyType, списки - кортежи"""
+    if isinstance(value, dict):
+        return pytypes.MappingProxyType({key: freeze_config(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze_config(item) for item in value)
+    return value
+
+
+class ConfigStore:
+    """
+    Хранилище конфигурации. Читатели получают неизменяемые снимки, изменения выполняются
+    под блокировкой через edit(), а запись на диск откладывается, чтобы серия правок дала одну запись.
+    """
+
+    def __init__(self, path, data, debounce=CONFIG_SAVE_DEBOUNCE, on_change=None):
+        self.path = path
+        self.debounce = debounce
+        self.on_change = on_change
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._data = copy.deepcopy(data)
+        self._snapshot = freeze_config(self._data)
+        self._timer = None
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot
+
+    @contextlib.contextmanager
+    def edit(self):
+        """Изменяемая копия конфигурации. Применяется целиком при выходе из блока без исключения"""
+        with self._lock:
+            draft = copy.deepcopy(self._data)
+            yield draft
+            self._data = draft
+            self._snapshot = freeze_config(draft)
+            if self.on_change:
+                self.on_change(self._snapshot)
+            self._schedule_save()
+
+    def _schedule_save(self):
+        if self._timer is not None:
+            return
+        self._timer = threading.Timer(self.debounce, self._save)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _save(self):
+        with self._lock:
+            self._timer = None
+            data = copy.deepcopy(self._data)
+        with self._write_lock:
+            try:
+                write_json_atomic(self.path, data)
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка при сохранении конфигурации: {e}")
+
+    def flush(self):
+        """Немедленно записывает отложенные изменения"""
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+            self._save()
+
+
+def apply_config(snapshot):
+    """Делает новый снимок конфигурации текущим для всех потоков"""
+    global config
+    config = snapshot
+
+
+class ProfitLedger:
+    """Журнал прибыли только на дозапись с поддерживаемой суммой по всем заказам"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._records = {}
+        self._total = 0.0
+        self._load(path)
+        self._file = open(path, 'a', encoding='utf-8')
+        if self._file.tell() > 0 and not self._ends_with_newline(path):
+            # Дописываем перевод строки после оборванной записи, чтобы не склеить её со следующей
+            self._file.write("\n")
+
+    @staticmethod
+    def _ends_with_newline(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _load(self, path):
+        if not os.path.exists(path):
+            return
+
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if not isinstance(record, dict) or "order_id" not in record:
+                    logger.warning(f"{LOGGER_PREFIX} Пропущена повреждённая строка {line_number} в {path}")
+                    continue
+                self._apply(record)
+
+    def _apply(self, record):
+        order_id = str(record.pop("order_id"))
+        previous = self._records.get(order_id)
+        if previous:
+            self._total -= previous.get("profit", 0)
+        self._records[order_id] = record
+        self._total += record.get("profit", 0)
+
+    def append(self, order_id, record):
+        line = json.dumps(dict(record, order_id=str(order_id)), ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            self._apply(dict(record, order_id=str(order_id)))
+
+    def migrate_from_config(self, orders_profit):
+        """Одноразовый перенос orders_profit из config.json"""
+        for order_id, record in orders_profit.items():
+            if self.get(order_id) is None:
+                self.append(order_id, record)
+
+    def get(self, order_id):
+        with self._lock:
+            record = self._records.get(str(order_id))
+            return dict(record) if record else None
+
+    def total(self):
+        with self._lock:
+            return self._total
+
+    def close(self):
+        with self._lock:
+            self._file.close()
 
 
 def save_order_profit(order_id, fp_sum, lolz_cost):
     """Сохранение информации о прибыли от заказа"""
     try:
         profit = float(fp_sum) - float(lolz_cost)
-        config["orders_profit"][str(order_id)] = {
+        profit_ledger.append(order_id, {
             "fp_sum": fp_sum,
             "lolz_cost": lolz_cost,
             "profit": profit,
             "date": time.strftime("%Y-%m-%d %H:%M:%S")
-        }
-        save_config()
+        })
         logger.info(f"{LOGGER_PREFIX} Сохранена информация о прибыли для заказа #{order_id}: {profit} руб.")
         return True
     except Exception as e:
@@ -252,15 +695,138 @@ def save_order_profit(order_id, fp_sum, lolz_cost):
 
 def get_order_profit(order_id):
     """Получение информации о прибыли от заказа"""
-    return config["orders_profit"].get(str(order_id))
+    return profit_ledger.get(order_id)
 
 
 def get_total_profit():
     """Получение общей прибыли от всех заказов"""
-    total = 0
-    for order_data in config["orders_profit"].values():
-        total += order_data.get("profit", 0)
-    return total
+    return profit_ledger.total()
+
+
+class OrderIndex:
+    """
+    Отсортированный по дате индекс заказов для меню администратора.
+    Хранится по возрастанию, поэтому новая продажа добавляется в конец за O(1),
+    а позиции уже проиндексированных заказов при этом не сдвигаются.
+    """
+
+    NO_DATA = "Нет данных"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []
+        self._positions = {}
+        self._rows = {}
+        self._seq = 0
+
+    def rebuild(self):
+        """Полное построение индекса из хранилища заказов и журнала прибыли"""
+        rows = [self._make_row(order_data) for order_data in order_store.get_all_orders()]
+        rows.sort(key=lambda row: row["date"])
+        with self._lock:
+            self._keys = []
+            self._rows = {}
+            for row in rows:
+                self._seq += 1
+                self._keys.append((row["date"], self._seq, row["order_id"]))
+                self._rows[row["order_id"]] = row
+            self._reindex()
+
+    def _make_row(self, order_data):
+        profit_data = get_order_profit(order_data["order_id"])
+        return {
+            "order_id": order_data["order_id"],
+            "user_id": order_data["user_id"],
+            "phone": order_data["phone"] or self.NO_DATA,
+            "profit": profit_data.get("profit", 0) if profit_data else 0,
+            "date": profit_data.get("date", self.NO_DATA) if profit_data else self.NO_DATA
+        }
+
+    def _reindex(self):
+        self._positions = {key[2]: i for i, key in enumerate(self._keys)}
+
+    def upsert(self, order_id):
+        """Добавляет или обновляет заказ после записи в хранилище и журнал прибыли"""
+        order_data = order_store.get_order(order_id)
+        if not order_data:
+            return
+
+        row = self._make_row(order_data)
+        order_id = row["order_id"]
+
+        with self._lock:
+            current = self._rows.get(order_id)
+            self._rows[order_id] = row
+            if current and current["date"] == row["date"]:
+                return
+
+            if current:
+                del self._keys[self._positions[order_id]]
+                self._reindex()
+
+            self._seq += 1
+            key = (row["date"], self._seq, order_id)
+            if not self._keys or key >= self._keys[-1]:
+                self._keys.append(key)
+                self._positions[order_id] = len(self._keys) - 1
+            else:
+                bisect.insort(self._keys, key)
+                self._reindex()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
+
+    def get_page(self, page, page_size):
+        """Страница заказов от новых к старым: (заказы, номер страницы, всего страниц)"""
+        with self._lock:
+            count = len(self._keys)
+            if not count:
+                return [], 0, 0
+
+            total_pages = (count - 1) // page_size + 1
+            page = max(0, min(page, total_pages - 1))
+            end = count - page * page_size
+            start = max(0, end - page_size)
+            rows = [dict(self._rows[key[2]]) for key in reversed(self._keys[start:end])]
+            return rows, page, total_pages
+
+    def page_of(self, order_id, page_size):
+        """Номер страницы, на которой находится заказ"""
+        with self._lock:
+            position = self._positions.get(str(order_id))
+            if position is None:
+                return 0
+            return (len(self._keys) - 1 - position) // page_size
+
+
+class CountryIndex:
+    """Префиксное дерево кодов стран: поиск самого длинного совпадающего префикса tg_id"""
+
+    def __init__(self, codes=()):
+        self._root = {}
+        for code in codes:
+            node = self._root
+            for char in code:
+                node = node.setdefault(char, {})
+            node[None] = code
+
+    def lookup(self, tg_id):
+        """Код страны с самым длинным префиксом; время зависит только от длины tg_id"""
+        node = self._root
+        match = None
+        for char in tg_id:
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get(None, match)
+        return match
+
+
+def rebuild_country_index():
+    """Перестраивает индекс стран после изменения списка стран"""
+    global country_index
+    country_index = CountryIndex(config["countries"].keys())
 
 
 def set_origin(call: types.CallbackQuery):
@@ -272,84 +838,270 @@ def set_origin(call: types.CallbackQuery):
         origin_code = "self_registration"
 
     if origin_code in ORIGIN_MAP:
-        if origin_code in config["origins"]:
-            if len(config["origins"]) > 1:
-                config["origins"].remove(origin_code)
-                action_text = "удалено"
+        with config_store.edit() as cfg:
+            if origin_code in cfg["origins"]:
+                if len(cfg["origins"]) > 1:
+                    cfg["origins"].remove(origin_code)
+                    action_text = "удалено"
+                else:
+                    action_text = None
             else:
-                bot.answer_callback_query(call.id, "Нельзя удалить последний тип происхождения")
-                return
-        else:
-            config["origins"].append(origin_code)
-            action_text = "добавлено"
+                cfg["origins"].append(origin_code)
+                action_text = "добавлено"
 
-        save_config()
+        if action_text is None:
+            bot.answer_callback_query(call.id, "Нельзя удалить последний тип происхождения")
+            return
         bot.answer_callback_query(call.id, f"Происхождение '{ORIGIN_MAP[origin_code]}' {action_text}")
 
     show_tg_settings_callback(call)
 
 
-def import_existing_orders(c: Cardinal):
-    """Импортирует существующие заказы и их номера в систему сохранения данных"""
-    try:
+class SellsImporter:
+    """
+    Фоновый импорт истории продаж FunPay. Обходит все страницы get_sells с паузой между запросами
+    и сохраняет курсор в meta хранилища, поэтому после перезапуска импорт продолжается с места остановки.
+    Для продаж, по которым аккаунт был куплен (отметка в order_states), но запись о заказе не сохранилась,
+    добавляет запись покупатель - номер - лот. Недостающие номера дополняются из истории покупок LZT Market.
+    Индекс продаж для команды "cd" импорт не заполняет: он строится одинаково при каждом запуске.
+    """
+
+    def __init__(self, page_delay=IMPORT_PAGE_DELAY, history_max_pages=IMPORT_HISTORY_MAX_PAGES):
+        self.page_delay = page_delay
+        self.history_max_pages = history_max_pages
+        self._imported = 0
+        self._journaled = set()
+        self._stop = threading.Event()
+
+    def run(self, c: Cardinal):
+        """Запускается в отдельном потоке и не задерживает инициализацию плагина"""
         logger.info(f"{LOGGER_PREFIX} Импорт существующих заказов в систему сохранения...")
-        
-        # Сначала получаем данные об аккаунте
         try:
-            account_data = c.account.get()
-            logger.info(f"{LOGGER_PREFIX} Данные аккаунта получены успешно")
-        except Exception as account_error:
-            logger.error(f"{LOGGER_PREFIX} Ошибка при получении данных аккаунта: {account_error}")
-            return
-        
-        user_orders_data = load_user_orders()
+            restored = self.restore_bindings()
+            logger.info(f"{LOGGER_PREFIX} Восстановлено {restored} привязок номеров из хранилища")
 
-        try:
-            next_order, orders = c.account.get_sells()
-        except Exception as sells_error:
-            logger.error(f"{LOGGER_PREFIX} Ошибка при получении списка продаж: {sells_error}")
-            return
+            self._imported = 0
+            # Эти заказы дообработает process_order: он же выдаст номер покупателю
+            self._journaled = {record["id"] for record in order_journal.pending_orders()} if order_journal else set()
+            browsed = self.import_head(c)
+            if not order_store.get_meta("import_done"):
+                browsed += self.import_tail(c)
+
+            filled = self.backfill_from_lzt()
+            if filled:
+                logger.info(f"{LOGGER_PREFIX} Дополнено {filled} привязок из истории покупок LZT Market")
+
+            logger.info(
+                f"{LOGGER_PREFIX} Импорт заказов завершен. Просмотрено {browsed} продаж, добавлено {self._imported} записей.")
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка при импорте существующих заказов: {e}")
+
+    def stop(self):
+        self._stop.set()
+
+    @staticmethod
+    def restore_bindings():
+        """Заполняет словари номеров и лотов по заказам из хранилища"""
+        restored = 0
+        for row in order_store.get_all_orders():
+            if row["phone"]:
+                order_phone_numbers[row["order_id"]] = row["phone"]
+                restored += 1
+            if row["item_id"]:
+                order_account_ids[row["order_id"]] = row["item_id"]
+        return restored
+
+    def backfill_from_lzt(self):
+        """Дополняет заказы без номера или лота по истории покупок LZT Market (связь номер - лот)"""
+        incomplete = order_store.get_incomplete_orders()
+        if not incomplete or not config["lolz_token"]:
+            return 0
+
+        phone_to_item, item_to_phone = self._load_purchase_history()
+        filled = 0
+        for row in incomplete:
+            phone = row["phone"] or item_to_phone.get(row["item_id"])
+            item_id = row["item_id"] or phone_to_item.get(row["phone"])
+            if not phone or not item_id:
+                continue
+            order_store.update_binding(row["order_id"], phone, item_id)
+            order_phone_numbers[row["order_id"]] = phone
+            order_account_ids[row["order_id"]] = item_id
+            filled += 1
+        return filled
+
+    def _load_purchase_history(self):
+        phone_to_item, item_to_phone = {}, {}
+        for page in range(1, self.history_max_pages + 1):
+            if self._stop.is_set():
+                break
+            try:
+                response = lzt_client.purchase_history(page)
+                if response.status_code != 200:
+                    logger.warning(
+                        f"{LOGGER_PREFIX} Не удалось получить историю покупок LZT Market: {response.status_code}")
+                    break
+                items = response.json().get("items") or []
+            except Exception as e:
+                logger.warning(f"{LOGGER_PREFIX} Ошибка при получении истории покупок LZT Market: {e}")
+                break
 
-        imported_count = 0
+            for item in items:
+                phone, item_id = item.get("telegram_phone"), item.get("item_id")
+                if phone and item_id:
+                    phone_to_item[str(phone)] = item_id
+                    item_to_phone[item_id] = str(phone)
+            if not items:
+                break
+        return phone_to_item, item_to_phone
 
+    def _fetch_page(self, c: Cardinal, start_from):
+        next_order, orders = c.account.get_sells(start_from=start_from)
         for order in orders:
-            if order.id in order_phone_numbers and order.id in order_account_ids:
-                phone = order_phone_numbers[order.id]
-                item_id = order_account_ids[order.id]
-                user_id = str(order.buyer_username)
-
-                if user_id not in user_orders_data["user_orders"]:
-                    user_orders_data["user_orders"][user_id] = {}
-
-                if str(order.id) not in user_orders_data["user_orders"][user_id]:
-                    user_orders_data["user_orders"][user_id][str(order.id)] = {
-                        "phone": phone,
-                        "item_id": item_id
-                    }
-                    user_orders_data["phone_users"][phone] = user_id
-                    imported_count += 1
-
-        save_user_orders(user_orders_data)
-        logger.info(f"{LOGGER_PREFIX} Импорт заказов завершен. Добавлено {imported_count} записей.")
-        
-    except Exception as e:
-        logger.error(f"{LOGGER_PREFIX} Ошибка при импорте существующих заказов: {e}")
+            if order.id not in self._journaled and self._import_order(order):
+                self._imported += 1
+        return next_order, orders
+
+    @staticmethod
+    def _import_order(order):
+        """Сохраняет запись о заказе, если аккаунт по нему куплен, а запись отсутствует"""
+        state = order_store.get_order_state(order.id)
+        if not state or state["state"] != ORDER_STATE_PURCHASED or order_store.get_order(order.id):
+            return False
+        if not order_store.add_order(str(order.buyer_username), order.id, state["phone"], state["item_id"],
+                                     replace=False):
+            return False
+        if state["phone"]:
+            order_phone_numbers[order.id] = state["phone"]
+        if state["item_id"]:
+            order_account_ids[order.id] = state["item_id"]
+        order_store.clear_order_state(order.id)
+        return True
+
+    def import_head(self, c: Cardinal):
+        """Продажи новее сохранённой границы: с первой страницы до уже импортированного заказа"""
+        newest_known = order_store.get_meta("import_newest")
+        start_from = None
+        new_newest = None
+        count = 0
+
+        while not self._stop.is_set():
+            next_order, orders = self._fetch_page(c, start_from)
+            if orders and new_newest is None:
+                new_newest = orders[0].id
+                if not newest_known:
+                    # Первый запуск: верх истории становится границей, остальное проходит обход хвоста
+                    order_store.set_meta("import_newest", new_newest)
+                    order_store.set_meta("import_cursor", next_order or "")
+                    if not next_order:
+                        order_store.set_meta("import_done", "1")
+                    return len(orders)
+
+            reached_known = False
+            for order in orders:
+                if order.id == newest_known:
+                    reached_known = True
+                    break
+                count += 1
+
+            if reached_known or not next_order:
+                break
+            start_from = next_order
+            self._stop.wait(self.page_delay)
+
+        if new_newest and not self._stop.is_set():
+            order_store.set_meta("import_newest", new_newest)
+        return count
+
+    def import_tail(self, c: Cardinal):
+        """Продолжает обход старых страниц с сохранённого курсора"""
+        cursor = order_store.get_meta("import_cursor")
+        count = 0
+        while cursor and not self._stop.is_set():
+            self._stop.wait(self.page_delay)
+            if self._stop.is_set():
+                break
+            next_order, orders = self._fetch_page(c, cursor)
+            count += len(orders)
+            cursor = next_order
+            order_store.set_meta("import_cursor", cursor or "")
+            logger.debug(f"{LOGGER_PREFIX} Просмотрена страница продаж, следующий курсор: {cursor}")
+
+        if not cursor:
+            order_store.set_meta("import_done", "1")
+        return count
+
 
 def init_commands(c_: Cardinal):
-    global bot, cardinal_instance, config, executor
+    global bot, cardinal_instance, config, config_store, executor, lzt_client, lzt_rate_limiter, order_dispatcher
+    global inventory_cache, order_store, profit_ledger, order_index, sells_index, code_poller
+    global validation_executor, admin_notifier, buyer_outbox, order_journal, lzt_breaker, sells_importer
+    global code_request_scheduler
     logger.info("=== init_commands() from TelegramAccounts ===")
 
     cardinal_instance = c_
     bot = c_.telegram.bot
-    config = ensure_config_exists()
+    config_store = ConfigStore(CONFIG_PATH, ensure_config_exists(), on_change=apply_config)
+    config = config_store.snapshot()
 
-    load_user_orders()
+    order_store = OrderStore(ORDERS_DB_PATH)
+    order_store.migrate_from_json(USER_ORDERS_PATH)
 
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    profit_ledger = ProfitLedger(PROFIT_LEDGER_PATH)
+    if config.get("orders_profit"):
+        logger.info(f"{LOGGER_PREFIX} Перенос {len(config['orders_profit'])} записей о прибыли в {PROFIT_LEDGER_PATH}")
+        profit_ledger.migrate_from_config(config["orders_profit"])
+    if "orders_profit" in config:
+        with config_store.edit() as cfg:
+            del cfg["orders_profit"]
 
-    threading.Thread(target=import_existing_orders, args=(c_,), daemon=True).start()
+    order_index = OrderIndex()
+    order_index.rebuild()
 
-    threading.Thread(target=process_order_queue, daemon=True).start()
+    rebuild_country_index()
+
+    sells_index = SellsIndex()
+
+    lzt_rate_limiter = RateLimiter(config["rate_limits"])
+    lzt_breaker = CircuitBreaker(on_open=on_lzt_breaker_open, on_close=on_lzt_breaker_close)
+    lzt_client = LztClient(rate_limiter=lzt_rate_limiter, breaker=lzt_breaker)
+    # Пул рассчитан на верхнюю границу, фактическое число заказов в работе ограничивает диспетчер
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=CONCURRENCY_HARD_LIMIT)
+    order_dispatcher = OrderDispatcher(executor, INITIAL_CONCURRENCY, config["concurrency_min"], config["concurrency_max"])
+    validation_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, get_prevalidate_count()))
+
+    threading.Thread(target=order_dispatcher.run, daemon=True).start()
+    threading.Thread(target=lzt_breaker.run, args=(lzt_client.probe,), daemon=True).start()
+
+    order_journal = OrderJournal(ORDER_JOURNAL_PATH)
+    threading.Thread(target=order_journal.run, daemon=True).start()
+
+    inventory_cache = InventoryCache()
+    threading.Thread(target=inventory_cache.run, daemon=True).start()
+
+    code_poller = CodePoller()
+    threading.Thread(target=code_poller.run, daemon=True).start()
+
+    code_request_scheduler = CodeRequestScheduler()
+    code_request_scheduler.start()
+
+    admin_notifier = AdminNotifier()
+    threading.Thread(target=admin_notifier.run, daemon=True).start()
+
+    buyer_outbox = BuyerOutbox()
+    threading.Thread(target=buyer_outbox.run, daemon=True).start()
+
+    threading.Thread(target=metrics.run_exporter, args=(METRICS_PATH,), daemon=True).start()
+
+    pending_orders = order_journal.pending_orders()
+    if pending_orders:
+        logger.info(f"{LOGGER_PREFIX} Восстановлено {len(pending_orders)} необработанных заказов из журнала")
+    for order_record in pending_orders:
+        order_dispatcher.submit(c_, JournaledOrderEvent(order_record))
+
+    # Импорт запускается после журнала: прерванные заказы из журнала восстанавливает process_order
+    sells_importer = SellsImporter()
+    threading.Thread(target=sells_importer.run, args=(c_,), daemon=True).start()
 
     _all_handlers = [handler for handler_group in bot.callback_query_handlers for handler in handler_group]
     logger.info(f"{LOGGER_PREFIX} Всего зарегистрировано {len(_all_handlers)} обработчиков callback-запросов")
@@ -373,6 +1125,8 @@ def init_commands(c_: Cardinal):
             handle_edit_country_min(call)
         elif call.data.startswith("tg_edit_country_max_"):
             handle_edit_country_max(call)
+        elif call.data.startswith("tg_edit_country_weight_"):
+            handle_edit_country_weight(call)
         elif call.data.startswith("tg_edit_country_"):
             handle_edit_country_menu(call)
         elif call.data == "tg_countries":
@@ -409,6 +1163,12 @@ def init_commands(c_: Cardinal):
             set_origin(call)
         elif call.data == "tg_setup_plugin":
             plugin_setup_menu(call)
+        elif call.data in ("tg_concurrency_min", "tg_concurrency_max"):
+            handle_edit_concurrency(call)
+        elif call.data == "tg_toggle_hold":
+            toggle_hold_on_outage(call)
+        elif call.data == "tg_queue_priority":
+            toggle_queue_priority(call)
         elif call.data == "tg_back_to_main":
             show_tg_settings_callback(call)
         elif call.data == "tg_message_templates":
@@ -432,6 +1192,15 @@ def init_commands(c_: Cardinal):
         """Регистрация команды /tg_settings"""
         show_tg_settings(message)
 
+    @bot.message_handler(commands=['tg_stats'])
+    def tg_stats_command(message: types.Message):
+        """Регистрация команды /tg_stats"""
+        bot.send_message(
+            message.chat.id,
+            f"{metrics.render_text()}\n\n{get_dispatcher_stats_text()}",
+            parse_mode="HTML"
+        )
+
     def handle_countries_menu(call: types.CallbackQuery):
         kb = InlineKeyboardMarkup(row_width=1)
         kb.add(InlineKeyboardButton("➕ Добавить страну", callback_data="tg_add_country"))
@@ -464,7 +1233,8 @@ def init_commands(c_: Cardinal):
 
         if call.data.startswith("tg_edit_country_name_") or \
                 call.data.startswith("tg_edit_country_min_") or \
-                call.data.startswith("tg_edit_country_max_"):
+                call.data.startswith("tg_edit_country_max_") or \
+                call.data.startswith("tg_edit_country_weight_"):
             logger.info(f"{LOGGER_PREFIX} Пропускаем обработку, так как это специфичный callback: {call.data}")
             return
 
@@ -482,6 +1252,8 @@ def init_commands(c_: Cardinal):
                 InlineKeyboardButton("✏️ Изменить название", callback_data=f"tg_edit_country_name_{country_code}"),
                 InlineKeyboardButton("💰 Изменить мин. цену", callback_data=f"tg_edit_country_min_{country_code}"),
                 InlineKeyboardButton("💎 Изменить макс. цену", callback_data=f"tg_edit_country_max_{country_code}"),
+                InlineKeyboardButton("⚖️ Изменить вес в очереди",
+                                     callback_data=f"tg_edit_country_weight_{country_code}"),
                 InlineKeyboardButton("🗑️ Удалить страну", callback_data=f"tg_delete_country_{country_code}"),
                 InlineKeyboardButton("🔙 Назад", callback_data="tg_countries")
             )
@@ -489,7 +1261,8 @@ def init_commands(c_: Cardinal):
             bot.edit_message_text(
                 f"Настройки страны: {country_data['name']} ({country_code})\n"
                 f"Минимальная цена: {country_data['min_price']}₽\n"
-                f"Максимальная цена: {country_data['max_price']}₽",
+                f"Максимальная цена: {country_data['max_price']}₽\n"
+                f"Вес в очереди заказов: {country_data.get('weight', 1)}",
                 call.message.chat.id,
                 call.message.message_id,
                 reply_markup=kb
@@ -568,6 +1341,30 @@ def init_commands(c_: Cardinal):
             bot.answer_callback_query(call.id, "Произошла ошибка при обработке запроса")
             handle_countries_menu(call)
 
+    def handle_edit_country_weight(call: types.CallbackQuery):
+        logger.info(f"{LOGGER_PREFIX} Обработка редактирования веса страны: {call.data}")
+        country_code = call.data.replace("tg_edit_country_weight_", "")
+
+        if country_code not in config["countries"]:
+            bot.answer_callback_query(call.id, f"Ошибка: страна с кодом {country_code} больше не существует!")
+            return handle_countries_menu(call)
+
+        try:
+            msg = bot.edit_message_text(
+                f"Введите вес страны {config['countries'][country_code]['name']} ({country_code}) в очереди заказов.\n"
+                f"Страна с весом 2 получает вдвое больше слотов, чем страна с весом 1, когда заказы ждут в обеих:",
+                call.message.chat.id,
+                call.message.message_id,
+                reply_markup=InlineKeyboardMarkup().add(
+                    InlineKeyboardButton("🔙 Отмена", callback_data=f"tg_edit_country_{country_code}")
+                )
+            )
+            bot.register_next_step_handler(msg, process_country_weight_edit, country_code)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка при редактировании веса страны: {e}")
+            bot.answer_callback_query(call.id, "Произошла ошибка при обработке запроса")
+            handle_countries_menu(call)
+
     def handle_delete_country(call: types.CallbackQuery):
         country_code = call.data.replace("tg_delete_country_", "")
         kb = InlineKeyboardMarkup(row_width=2)
@@ -586,8 +1383,9 @@ def init_commands(c_: Cardinal):
     def handle_confirm_delete_country(call: types.CallbackQuery):
         country_code = call.data.replace("tg_confirm_delete_country_", "")
         country_name = config["countries"][country_code]["name"]
-        del config["countries"][country_code]
-        save_config()
+        with config_store.edit() as cfg:
+            cfg["countries"].pop(country_code, None)
+        rebuild_country_index()
 
         bot.answer_callback_query(call.id, f"Страна {country_name} удалена!")
         handle_countries_menu(call)
@@ -639,8 +1437,8 @@ def init_commands(c_: Cardinal):
                 bot.clear_step_handler_by_chat_id(message.chat.id)
                 return show_tg_settings(message)
 
-            config["administrators"].append(admin_id)
-            save_config()
+            with config_store.edit() as cfg:
+                cfg["administrators"].append(admin_id)
             bot.clear_step_handler_by_chat_id(message.chat.id)
             bot.send_message(message.chat.id, f"✅ Администратор с ID {admin_id} добавлен!")
             show_tg_settings(message)
@@ -668,9 +1466,9 @@ def init_commands(c_: Cardinal):
     @bot.callback_query_handler(func=lambda call: call.data.startswith("tg_confirm_delete_admin_"))
     def delete_admin_confirmed(call: types.CallbackQuery):
         admin_id = int(call.data.split("_")[-1])
-        if admin_id in config["administrators"]:
-            config["administrators"].remove(admin_id)
-            save_config()
+        with config_store.edit() as cfg:
+            if admin_id in cfg["administrators"]:
+                cfg["administrators"].remove(admin_id)
 
         bot.answer_callback_query(call.id, f"Администратор {admin_id} удален!")
         admin_menu(call)
@@ -699,15 +1497,15 @@ def init_commands(c_: Cardinal):
 
     @bot.callback_query_handler(func=lambda call: call.data == "tg_auto_returns_on")
     def auto_returns_on(call: types.CallbackQuery):
-        config["auto_returns"] = True
-        save_config()
+        with config_store.edit() as cfg:
+            cfg["auto_returns"] = True
         bot.answer_callback_query(call.id, "Автовозвраты включены!")
         auto_returns_menu(call)
 
     @bot.callback_query_handler(func=lambda call: call.data == "tg_auto_returns_off")
     def auto_returns_off(call: types.CallbackQuery):
-        config["auto_returns"] = False
-        save_config()
+        with config_store.edit() as cfg:
+            cfg["auto_returns"] = False
         bot.answer_callback_query(call.id, "Автовозвраты выключены!")
         auto_returns_menu(call)
 
@@ -759,8 +1557,8 @@ def init_commands(c_: Cardinal):
             logger.error(f"{LOGGER_PREFIX} Ошибка при удалении сообщения: {e}")
 
         token = message.text.strip()
-        config["lolz_token"] = token
-        save_config()
+        with config_store.edit() as cfg:
+            cfg["lolz_token"] = token
 
         bot.clear_step_handler_by_chat_id(message.chat.id)
 
@@ -786,8 +1584,8 @@ def init_commands(c_: Cardinal):
 
     @bot.callback_query_handler(func=lambda call: call.data == "tg_confirm_delete_lolz_token")
     def delete_lolz_token_confirmed(call: types.CallbackQuery):
-        config["lolz_token"] = ""
-        save_config()
+        with config_store.edit() as cfg:
+            cfg["lolz_token"] = ""
         bot.answer_callback_query(call.id, "LOLZ токен удален!")
         lolz_token_menu(call)
 
@@ -842,11 +1640,33 @@ def init_commands(c_: Cardinal):
     def plugin_setup_menu(call: types.CallbackQuery):
         """Меню настройки плагина"""
         kb = InlineKeyboardMarkup(row_width=1)
+        kb.add(
+            InlineKeyboardButton(f"🔽 Мин. параллельность: {config['concurrency_min']}",
+                                 callback_data="tg_concurrency_min"),
+            InlineKeyboardButton(f"🔼 Макс. параллельность: {config['concurrency_max']}",
+                                 callback_data="tg_concurrency_max"),
+            InlineKeyboardButton(
+                f"⏸ Удерживать заказы при сбое LZT: {'✅' if config.get('hold_on_lzt_outage') else '❌'}",
+                callback_data="tg_toggle_hold"),
+            InlineKeyboardButton(
+                f"📊 Приоритет очереди: {QUEUE_PRIORITY_NAMES.get(config.get('queue_priority'), QUEUE_PRIORITY_NAMES['fair'])}",
+                callback_data="tg_queue_priority")
+        )
         kb.add(InlineKeyboardButton("🔙 Назад", callback_data="tg_back_to_main"))
 
+        current_limit = order_dispatcher.get_stats()["limit"] if order_dispatcher else "-"
         message_text = (
             "⚙️ <b>Настройка плагина</b>\n\n"
-            "Текущая функциональность плагина еще будет расширяться в следующих версиях."
+            f"Параллельность обработки заказов подстраивается автоматически под задержки и ошибки LZT Market "
+            f"в пределах заданных границ.\n\n"
+            f"Текущая параллельность: {current_limit}\n"
+            f"Границы: {config['concurrency_min']}-{config['concurrency_max']} (не больше {CONCURRENCY_HARD_LIMIT})\n\n"
+            f"При включённом удержании заказы, пришедшие во время недоступности LZT Market, не возвращаются, "
+            f"а откладываются и обрабатываются автоматически после восстановления.\n\n"
+            f"Заказы разных стран стоят в отдельных очередях и берутся по очереди с учётом веса страны. "
+            f"Приоритет по сумме или по возрасту меняет порядок выбора, а заказ, ждущий дольше "
+            f"{QUEUE_STARVATION_AGE} сек., берётся первым в любом режиме.\n"
+            f"{get_lzt_status_text(order_dispatcher.held_count() if order_dispatcher else 0)}"
         )
 
         bot.edit_message_text(
@@ -857,6 +1677,34 @@ def init_commands(c_: Cardinal):
             parse_mode="HTML"
         )
 
+    def toggle_hold_on_outage(call: types.CallbackQuery):
+        with config_store.edit() as cfg:
+            cfg["hold_on_lzt_outage"] = not cfg.get("hold_on_lzt_outage", False)
+        bot.answer_callback_query(
+            call.id, "Удержание заказов включено!" if config["hold_on_lzt_outage"] else "Удержание заказов выключено!")
+        plugin_setup_menu(call)
+
+    def toggle_queue_priority(call: types.CallbackQuery):
+        with config_store.edit() as cfg:
+            current = cfg.get("queue_priority", "fair")
+            index = QUEUE_PRIORITY_MODES.index(current) if current in QUEUE_PRIORITY_MODES else -1
+            cfg["queue_priority"] = QUEUE_PRIORITY_MODES[(index + 1) % len(QUEUE_PRIORITY_MODES)]
+        bot.answer_callback_query(call.id, f"Приоритет очереди: {QUEUE_PRIORITY_NAMES[config['queue_priority']]}")
+        plugin_setup_menu(call)
+
+    def handle_edit_concurrency(call: types.CallbackQuery):
+        bound = call.data.replace("tg_concurrency_", "")
+        bound_name = "минимальную" if bound == "min" else "максимальную"
+        msg = bot.edit_message_text(
+            f"Введите {bound_name} параллельность обработки заказов (от 1 до {CONCURRENCY_HARD_LIMIT}):",
+            call.message.chat.id,
+            call.message.message_id,
+            reply_markup=InlineKeyboardMarkup().add(
+                InlineKeyboardButton("🔙 Отмена", callback_data="tg_setup_plugin")
+            )
+        )
+        bot.register_next_step_handler(msg, process_concurrency_edit, bound)
+
     def orders_menu(call: types.CallbackQuery):
         """Отображение меню заказов"""
         page = 0
@@ -870,45 +1718,15 @@ def init_commands(c_: Cardinal):
 
         PAGE_SIZE = 5
 
-        user_orders_data = load_user_orders()
         kb = InlineKeyboardMarkup(row_width=1)
 
         total_profit = get_total_profit()
 
         message_text = f"📋 <b>Управление заказами</b>\n\n💰 <b>Общая чистая прибыль:</b> {total_profit:.2f} руб.\n\n"
 
-        all_orders = []
-        for user_id, orders in user_orders_data["user_orders"].items():
-            for order_id, order_data in orders.items():
-                if order_id in config["orders_profit"]:
-                    profit_data = config["orders_profit"][order_id]
-                    all_orders.append({
-                        "order_id": order_id,
-                        "user_id": user_id,
-                        "phone": order_data.get("phone", "Нет данных"),
-                        "profit": profit_data.get("profit", 0),
-                        "date": profit_data.get("date", "Нет данных")
-                    })
-                else:
-                    all_orders.append({
-                        "order_id": order_id,
-                        "user_id": user_id,
-                        "phone": order_data.get("phone", "Нет данных"),
-                        "profit": 0,
-                        "date": "Нет данных"
-                    })
-
-        all_orders.sort(key=lambda x: x.get("date", ""), reverse=True)
-
-        if all_orders:
-            total_pages = (len(all_orders) - 1) // PAGE_SIZE + 1
-            page = min(page, total_pages - 1)
-
-            start_idx = page * PAGE_SIZE
-            end_idx = min(start_idx + PAGE_SIZE, len(all_orders))
-
-            current_page_orders = all_orders[start_idx:end_idx]
+        current_page_orders, page, total_pages = order_index.get_page(page, PAGE_SIZE)
 
+        if current_page_orders:
             message_text += f"<b>Заказы (страница {page + 1}/{total_pages}):</b>\n"
 
             for order in current_page_orders:
@@ -943,39 +1761,9 @@ def init_commands(c_: Cardinal):
     def order_details(call: types.CallbackQuery):
         """Отображение деталей заказа"""
         order_id = call.data.split('_')[-1]
-        user_orders_data = load_user_orders()
-
-        all_orders = []
-        for uid, orders in user_orders_data["user_orders"].items():
-            for o_id, order_data in orders.items():
-                if o_id in config["orders_profit"]:
-                    profit_data = config["orders_profit"][o_id]
-                    all_orders.append({
-                        "order_id": o_id,
-                        "user_id": uid,
-                        "phone": order_data.get("phone", "Нет данных"),
-                        "profit": profit_data.get("profit", 0),
-                        "date": profit_data.get("date", "Нет данных")
-                    })
-                else:
-                    all_orders.append({
-                        "order_id": o_id,
-                        "user_id": uid,
-                        "phone": order_data.get("phone", "Нет данных"),
-                        "profit": 0,
-                        "date": "Нет данных"
-                    })
-
-        all_orders.sort(key=lambda x: x.get("date", ""), reverse=True)
-
-        order_index = -1
-        for i, order in enumerate(all_orders):
-            if order["order_id"] == order_id:
-                order_index = i
-                break
 
         PAGE_SIZE = 5
-        page = order_index // PAGE_SIZE if order_index != -1 else 0
+        page = order_index.page_of(order_id, PAGE_SIZE)
 
         kb = InlineKeyboardMarkup(row_width=1)
         if page > 0:
@@ -984,22 +1772,14 @@ def init_commands(c_: Cardinal):
         else:
             kb.add(InlineKeyboardButton("🔙 К списку заказов", callback_data="tg_orders"))
 
-        found_order = False
-        order_details = {}
-        user_id = None
-
-        for uid, orders in user_orders_data["user_orders"].items():
-            if order_id in orders:
-                found_order = True
-                user_id = uid
-                order_details = orders[order_id]
-                break
+        order_details = order_store.get_order(order_id)
 
-        if found_order:
-            phone = order_details.get("phone", "Нет данных")
-            item_id = order_details.get("item_id", "Нет данных")
+        if order_details:
+            user_id = order_details["user_id"]
+            phone = order_details["phone"] or "Нет данных"
+            item_id = order_details["item_id"] or "Нет данных"
 
-            profit_info = config["orders_profit"].get(order_id, {})
+            profit_info = get_order_profit(order_id) or {}
             fp_sum = profit_info.get("fp_sum", 0)
             lolz_cost = profit_info.get("lolz_cost", 0)
             profit = profit_info.get("profit", 0)
@@ -1103,8 +1883,8 @@ def init_commands(c_: Cardinal):
             show_tg_settings(message)
             return
 
-        config["purchase_template"] = new_template
-        save_config()
+        with config_store.edit() as cfg:
+            cfg["purchase_template"] = new_template
 
         bot.clear_step_handler_by_chat_id(message.chat.id)
 
@@ -1154,8 +1934,8 @@ def init_commands(c_: Cardinal):
             show_tg_settings(message)
             return
 
-        config["code_template"] = new_template
-        save_config()
+        with config_store.edit() as cfg:
+            cfg["code_template"] = new_template
 
         bot.clear_step_handler_by_chat_id(message.chat.id)
 
@@ -1249,12 +2029,13 @@ def add_country_step5(message: types.Message, country_code: str, country_name: s
             bot.send_message(message.chat.id, "❌ Максимальная цена не может быть меньше минимальной!")
             return show_tg_settings(message)
 
-        config["countries"][country_code] = {
-            "name": country_name,
-            "min_price": min_price,
-            "max_price": max_price
-        }
-        save_config()
+        with config_store.edit() as cfg:
+            cfg["countries"][country_code] = {
+                "name": country_name,
+                "min_price": min_price,
+                "max_price": max_price
+            }
+        rebuild_country_index()
 
         bot.clear_step_handler_by_chat_id(message.chat.id)
         bot.send_message(
@@ -1284,8 +2065,9 @@ def process_country_name_edit(message: types.Message, country_code: str):
             bot.send_message(message.chat.id, f"❌ Ошибка: страна с кодом {country_code} больше не существует!")
             return show_tg_settings(message)
 
-        config["countries"][country_code]["name"] = new_name
-        save_config()
+        with config_store.edit() as cfg:
+            cfg["countries"][country_code]["name"] = new_name
+        rebuild_country_index()
         bot.clear_step_handler_by_chat_id(message.chat.id)
         bot.send_message(message.chat.id, f"✅ Название страны {country_code} изменено на {new_name}!")
         show_tg_settings(message)
@@ -1317,8 +2099,9 @@ def process_country_min_edit(message: types.Message, country_code: str):
             bot.send_message(message.chat.id, "❌ Минимальная цена не может быть больше максимальной!")
             return show_tg_settings(message)
 
-        config["countries"][country_code]["min_price"] = new_min
-        save_config()
+        with config_store.edit() as cfg:
+            cfg["countries"][country_code]["min_price"] = new_min
+        rebuild_country_index()
         bot.clear_step_handler_by_chat_id(message.chat.id)
         bot.send_message(message.chat.id, f"✅ Минимальная цена для страны {country_code} изменена на {new_min}₽!")
         show_tg_settings(message)
@@ -1333,6 +2116,48 @@ def process_country_min_edit(message: types.Message, country_code: str):
         show_tg_settings(message)
 
 
+def process_concurrency_edit(message: types.Message, bound: str):
+    if message.text is None:
+        return
+
+    try:
+        bot.delete_message(message.chat.id, message.message_id - 1)
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка при удалении сообщения: {e}")
+
+    try:
+        value = int(message.text.strip())
+        if value < 1 or value > CONCURRENCY_HARD_LIMIT:
+            bot.clear_step_handler_by_chat_id(message.chat.id)
+            bot.send_message(message.chat.id, f"❌ Параллельность должна быть от 1 до {CONCURRENCY_HARD_LIMIT}!")
+            return show_tg_settings(message)
+
+        min_limit = value if bound == "min" else config["concurrency_min"]
+        max_limit = value if bound == "max" else config["concurrency_max"]
+        if min_limit > max_limit:
+            bot.clear_step_handler_by_chat_id(message.chat.id)
+            bot.send_message(message.chat.id, "❌ Минимальная параллельность не может быть больше максимальной!")
+            return show_tg_settings(message)
+
+        with config_store.edit() as cfg:
+            cfg["concurrency_min"] = min_limit
+            cfg["concurrency_max"] = max_limit
+        if order_dispatcher:
+            order_dispatcher.set_bounds(min_limit, max_limit)
+        bot.clear_step_handler_by_chat_id(message.chat.id)
+        bot.send_message(message.chat.id, f"✅ Границы параллельности изменены: {min_limit}-{max_limit}")
+        show_tg_settings(message)
+    except ValueError:
+        bot.clear_step_handler_by_chat_id(message.chat.id)
+        bot.send_message(message.chat.id, "❌ Введите корректное целое число!")
+        show_tg_settings(message)
+    except Exception as e:
+        bot.clear_step_handler_by_chat_id(message.chat.id)
+        logger.error(f"{LOGGER_PREFIX} Ошибка при сохранении границ параллельности: {e}")
+        bot.send_message(message.chat.id, "❌ Произошла ошибка при сохранении границ параллельности!")
+        show_tg_settings(message)
+
+
 def process_country_max_edit(message: types.Message, country_code: str):
     if message.text is None:
         return
@@ -1354,8 +2179,9 @@ def process_country_max_edit(message: types.Message, country_code: str):
             bot.send_message(message.chat.id, "❌ Максимальная цена не может быть меньше минимальной!")
             return show_tg_settings(message)
 
-        config["countries"][country_code]["max_price"] = new_max
-        save_config()
+        with config_store.edit() as cfg:
+            cfg["countries"][country_code]["max_price"] = new_max
+        rebuild_country_index()
         bot.clear_step_handler_by_chat_id(message.chat.id)
         bot.send_message(message.chat.id, f"✅ Максимальная цена для страны {country_code} изменена на {new_max}₽!")
         show_tg_settings(message)
@@ -1370,101 +2196,1363 @@ def process_country_max_edit(message: types.Message, country_code: str):
         show_tg_settings(message)
 
 
-def handle_new_order(c: Cardinal, e: NewOrderEvent, *args):
-    """
-    Обработчик новых заказов.
-    Добавляет заказ в очередь для асинхронной обработки.
-    """
-    order_id = e.order.id
-    logger.info(f"{LOGGER_PREFIX} Новый заказ #{order_id} добавлен в очередь на обработку")
-
-    order_queue.put({
-        'cardinal': c,
-        'event': e
-    })
-
+def process_country_weight_edit(message: types.Message, country_code: str):
+    if message.text is None:
+        return
 
-def send_message_to_buyer(c: Cardinal, username: str, message: str):
-    """Отправляет сообщение покупателю"""
     try:
-        chat_id = c.account.get_chat_by_name(username, make_request=True)
-        if chat_id:
-            c.account.send_message(chat_id.id, message)
-            logger.info(f"{LOGGER_PREFIX} Отправлено сообщение покупателю {username}")
-            return True
-        else:
-            logger.warning(f"{LOGGER_PREFIX} Не удалось найти чат с покупателем {username}")
-            return False
+        bot.delete_message(message.chat.id, message.message_id - 1)
     except Exception as e:
-        logger.error(f"{LOGGER_PREFIX} Ошибка при отправке сообщения покупателю {username}: {e}")
-        return False
+        logger.error(f"{LOGGER_PREFIX} Ошибка при удалении сообщения: {e}")
 
+    try:
+        if country_code not in config["countries"]:
+            bot.clear_step_handler_by_chat_id(message.chat.id)
+            bot.send_message(message.chat.id, f"❌ Ошибка: страна с кодом {country_code} больше не существует!")
+            return show_tg_settings(message)
 
-def find_available_accounts(country_code, min_price, max_price):
-    """Поиск доступных аккаунтов с сортировкой по возрастанию цены"""
-    available_accounts = []
+        new_weight = int(message.text.strip())
+        if not 1 <= new_weight <= 100:
+            bot.clear_step_handler_by_chat_id(message.chat.id)
+            bot.send_message(message.chat.id, "❌ Вес должен быть от 1 до 100!")
+            return show_tg_settings(message)
 
-    try:
-        timer = threading.Timer(3.0, lambda: None)
-        timer.start()
-        timer.join()
+        with config_store.edit() as cfg:
+            cfg["countries"][country_code]["weight"] = new_weight
+        bot.clear_step_handler_by_chat_id(message.chat.id)
+        bot.send_message(message.chat.id, f"✅ Вес страны {country_code} в очереди заказов изменён на {new_weight}!")
+        show_tg_settings(message)
+    except ValueError:
+        bot.clear_step_handler_by_chat_id(message.chat.id)
+        bot.send_message(message.chat.id, "❌ Введите корректное целое число!")
+        show_tg_settings(message)
+    except Exception as e:
+        bot.clear_step_handler_by_chat_id(message.chat.id)
+        logger.error(f"{LOGGER_PREFIX} Ошибка при сохранении веса страны: {e}")
+        bot.send_message(message.chat.id, "❌ Произошла ошибка при сохранении веса страны!")
+        show_tg_settings(message)
 
-        url = f"https://prod-api.lzt.market/telegram?order_by=price_to_up&pmin={min_price}&pmax={max_price}"
 
-        for origin in config["origins"]:
-            url += f"&origin[]={origin}"
+class JournaledOrder:
+    """Минимальное представление заказа из журнала, достаточное для process_order"""
 
-        url += f"&spam=no&allow_geo_spamblock=true&password=no&country[]={country_code}"
+    def __init__(self, record):
+        self.id = record["id"]
+        self.description = record.get("description")
+        self.buyer_username = record.get("buyer_username")
+        self.price = record.get("price")
+        self.amount = record.get("amount")
 
-        headers = {
-            "accept": "application/json",
-            "authorization": f"Bearer {config['lolz_token']}"
-        }
 
-        response = requests.get(url, headers=headers)
-        logger.info(f"{LOGGER_PREFIX} Запрос к API LOLZ Market: {url}")
+class JournaledOrderEvent:
+    """Заказ, восстановленный из журнала после перезапуска"""
 
-        if response.status_code == 200:
-            response_data = response.json()
+    def __init__(self, record):
+        self.order = JournaledOrder(record)
 
-            if 'items' in response_data and response_data['items']:
-                items = response_data['items']
-                logger.info(f"{LOGGER_PREFIX} Найдено {len(items)} аккаунтов")
-                available_accounts = items
-            else:
-                logger.info(f"{LOGGER_PREFIX} Нет доступных аккаунтов")
-        else:
-            logger.error(f"{LOGGER_PREFIX} Ошибка запроса к API LOLZ Market: {response.status_code}, {response.text}")
 
-    except Exception as e:
-        logger.error(f"{LOGGER_PREFIX} Ошибка при поиске аккаунтов: {e}")
+class OrderJournal:
+    """
+    Журнал принятых заказов на диске. Записи о новых заказах сбрасываются на диск пачками (group commit):
+    один fsync подтверждает все заказы, пришедшие за окно JOURNAL_GROUP_COMMIT_WINDOW.
+    """
 
-    logger.info(f"{LOGGER_PREFIX} Всего найдено {len(available_accounts)} доступных аккаунтов")
-    return available_accounts
+    def __init__(self, path, commit_window=JOURNAL_GROUP_COMMIT_WINDOW, compact_threshold=JOURNAL_COMPACT_THRESHOLD):
+        self.path = path
+        self.commit_window = commit_window
+        self.compact_threshold = compact_threshold
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._buffer = []
+        self._appended_seq = 0
+        self._committed_seq = 0
+        self._completed_since_compact = 0
+        self._deferred = set()
+        self._stopped = False
+        self._load()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
 
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("op") == "add":
+                    self._pending[record["order"]["id"]] = record["order"]
+                elif record.get("op") == "done":
+                    self._pending.pop(record["order_id"], None)
+
+    @staticmethod
+    def _serialize(order):
+        return {
+            "id": order.id,
+            "description": getattr(order, "description", None),
+            "buyer_username": getattr(order, "buyer_username", None),
+            "price": getattr(order, "price", None),
+            "amount": getattr(order, "amount", None)
+        }
 
-def try_purchase_accounts(accounts):
-    """Пытается купить аккаунты из списка по очереди, пока не найдет доступный"""
-    insufficient_funds = False
+    def pending_orders(self):
+        with self._cond:
+            return list(self._pending.values())
+
+    def append(self, order):
+        """Записывает заказ и ждёт подтверждения на диске. False, если заказ уже в журнале"""
+        record = self._serialize(order)
+        with self._cond:
+            if record["id"] in self._pending:
+                return False
+            self._pending[record["id"]] = record
+            self._buffer.append({"op": "add", "order": record})
+            self._appended_seq += 1
+            seq = self._appended_seq
+            self._cond.notify_all()
+
+            deadline = time.monotonic() + JOURNAL_APPEND_TIMEOUT
+            while self._committed_seq < seq and not self._stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.error(f"{LOGGER_PREFIX} Заказ #{record['id']} не подтверждён на диске, обработка без журнала")
+                    break
+                self._cond.wait(remaining)
+        return True
 
-    for account in accounts:
-        item_id = account.get('item_id')
-        price = account.get('price')
-        logger.info(f"{LOGGER_PREFIX} Попытка покупки аккаунта ID: {item_id}, цена: {price}₽")
+    def defer(self, order_id):
+        """Запись закроется только вызовом complete(order_id, delivered=True) после доставки сообщения"""
+        with self._cond:
+            if order_id in self._pending:
+                self._deferred.add(order_id)
+
+    def complete(self, order_id, delivered=False):
+        """Отмечает заказ обработанным, ожидание fsync не требуется"""
+        with self._cond:
+            if order_id in self._deferred:
+                if not delivered:
+                    return
+                self._deferred.discard(order_id)
+            if self._pending.pop(order_id, None) is None:
+                return
+            self._buffer.append({"op": "done", "order_id": order_id})
+            self._appended_seq += 1
+            self._completed_since_compact += 1
+            self._cond.notify_all()
+
+    def run(self):
+        """Поток записи журнала"""
+        while True:
+            with self._cond:
+                while not self._buffer and not self._stopped:
+                    self._cond.wait()
+                if self._stopped and not self._buffer:
+                    return
+
+            # Небольшое окно, чтобы собрать в один fsync заказы, пришедшие почти одновременно
+            time.sleep(self.commit_window)
+
+            with self._cond:
+                batch, self._buffer = self._buffer, []
+                seq = self._appended_seq
 
-        purchase_result = purchase_account(item_id)
+            try:
+                self._file.write("".join(json.dumps(r, ensure_ascii=False, separators=(',', ':')) + "\n" for r in batch))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка при записи журнала заказов: {e}")
+                with self._cond:
+                    # Пачка возвращается в начало буфера; повтор записи безопасен, _load идемпотентен
+                    self._buffer = batch + self._buffer
+                    if self._stopped:
+                        return
+                time.sleep(JOURNAL_RETRY_DELAY)
+                continue
+
+            with self._cond:
+                self._committed_seq = seq
+                self._cond.notify_all()
+                need_compact = self._completed_since_compact >= self.compact_threshold
+
+            if need_compact:
+                self._compact()
+
+    def _compact(self):
+        """Перезаписывает журнал, оставляя только необработанные заказы"""
+        with self._cond:
+            if self._buffer:
+                return
+            records = [{"op": "add", "order": order} for order in self._pending.values()]
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write("".join(json.dumps(r, ensure_ascii=False, separators=(',', ':')) + "\n" for r in records))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._file.close()
+                os.replace(tmp_path, self.path)
+                self._file = open(self.path, 'a', encoding='utf-8')
+                self._completed_since_compact = 0
+                logger.info(f"{LOGGER_PREFIX} Журнал заказов сжат, осталось записей: {len(records)}")
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка при сжатии журнала заказов: {e}")
+                if self._file.closed:
+                    self._file = open(self.path, 'a', encoding='utf-8')
+
+    def stop(self):
+        """Останавливает поток записи и ждёт, пока на диск попадут уже принятые записи"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            deadline = time.monotonic() + JOURNAL_APPEND_TIMEOUT
+            while self._committed_seq < self._appended_seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
 
-        if purchase_result and 'item' in purchase_result:
-            login_data = purchase_result['item'].get('loginData', {})
-            login = login_data.get('login', '')
-            password = login_data.get('password', '')
-            telegram_id = purchase_result['item'].get('telegram_id', '')
-            telegram_phone = purchase_result['item'].get('telegram_phone', '')
-            telegram_username = purchase_result['item'].get('telegram_username', '')
 
-            account_data = {
-                'login': login,
-                'password': password,
+def handle_new_order(c: Cardinal, e: NewOrderEvent, *args):
+    """
+    Обработчик новых заказов.
+    Добавляет заказ в очередь для асинхронной обработки.
+    """
+    order_id = e.order.id
+    sells_index.add_order(e.order)
+
+    if not order_journal.append(e.order):
+        logger.info(f"{LOGGER_PREFIX} Заказ #{order_id} уже находится в очереди на обработку")
+        return
+
+    order_dispatcher.submit(c, e)
+    logger.info(f"{LOGGER_PREFIX} Новый заказ #{order_id} добавлен в очередь на обработку")
+
+
+class SellsIndex:
+    """
+    Индекс продаж FunPay по покупателям для команды "cd".
+    Пополняется из NewOrderEvent и догружает get_sells только до последнего известного заказа.
+    """
+
+    def __init__(self, ttl=SELLS_INDEX_TTL, max_pages=SELLS_INDEX_MAX_PAGES):
+        self.ttl = ttl
+        self.max_pages = max_pages
+        self._lock = threading.Lock()
+        self._by_buyer = {}
+        self._newest_id = None
+        # Недогруженный разрыв: (start_from следующей страницы, ID самого нового заказа прохода)
+        self._resume = None
+        self._refreshed_at = None
+        self._refreshing = False
+        self._refresh_done = threading.Condition(self._lock)
+
+    def add_order(self, order):
+        with self._lock:
+            self._by_buyer.setdefault(order.buyer_username, {})[order.id] = order
+
+    def add_orders(self, orders):
+        with self._lock:
+            for order in orders:
+                self._by_buyer.setdefault(order.buyer_username, {})[order.id] = order
+
+    def refresh(self, c: Cardinal):
+        """Догружает продажи, появившиеся после последнего обновления"""
+        with self._lock:
+            newest_known = self._newest_id
+            resume = self._resume
+        # Первое построение ограничено одной страницей, как и прежний запрос get_sells
+        max_pages = self.max_pages if newest_known else 1
+
+        fetched = []
+        # Прошлый проход не дошёл до известного заказа - продолжаем с места остановки
+        start_from, newest_id = resume if resume else (None, None)
+        next_order = None
+        reached_known = False
+        for _ in range(max_pages):
+            next_order, orders = c.account.get_sells(start_from=start_from)
+            if newest_id is None and orders:
+                newest_id = orders[0].id
+
+            for order in orders:
+                if order.id == newest_known:
+                    reached_known = True
+                    break
+                fetched.append(order)
+
+            if reached_known or not next_order:
+                break
+            start_from = next_order
+
+        self.add_orders(fetched)
+        gap_left = bool(newest_known and not reached_known and next_order)
+        with self._lock:
+            if gap_left:
+                # За max_pages до известного заказа не дошли: граница остаётся прежней,
+                # иначе заказы между ней и последней загруженной страницей не попадут в индекс
+                self._resume = (next_order, newest_id)
+            else:
+                self._resume = None
+                if newest_id is not None:
+                    self._newest_id = newest_id
+            self._refreshed_at = time.monotonic()
+
+        if gap_left:
+            logger.info(f"{LOGGER_PREFIX} Индекс продаж обновлён частично, новых заказов: {len(fetched)}, "
+                        f"догрузка продолжится при следующем обновлении")
+        else:
+            logger.info(f"{LOGGER_PREFIX} Индекс продаж обновлён, новых заказов: {len(fetched)}")
+
+    def _run_refresh(self, c: Cardinal):
+        try:
+            self.refresh(c)
+        finally:
+            with self._lock:
+                self._refreshing = False
+                self._refresh_done.notify_all()
+
+    def _background_refresh(self, c: Cardinal):
+        try:
+            self._run_refresh(c)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка при обновлении индекса продаж: {e}")
+
+    def get_buyer_orders(self, c: Cardinal, username):
+        """
+        Заказы покупателя из памяти. Устаревший индекс обновляется в фоне,
+        синхронный запрос к FunPay выполняется только при самом первом обращении.
+        """
+        with self._lock:
+            refreshed_at = self._refreshed_at
+            stale = refreshed_at is None or time.monotonic() - refreshed_at > self.ttl
+            start_refresh = stale and not self._refreshing
+            if start_refresh:
+                self._refreshing = True
+            elif refreshed_at is None:
+                # Первое построение уже выполняет другой поток: ждём его вместо второго запроса get_sells
+                self._refresh_done.wait_for(lambda: not self._refreshing, SELLS_INDEX_BUILD_TIMEOUT)
+
+        if start_refresh and refreshed_at is None:
+            self._run_refresh(c)
+        elif start_refresh:
+            threading.Thread(target=self._background_refresh, args=(c,), daemon=True).start()
+
+        with self._lock:
+            return list(self._by_buyer.get(username, {}).values())
+
+
+class BuyerOutbox:
+    """
+    Очередь доставки сообщений покупателям с повторными попытками.
+    Кэширует chat_id по имени покупателя, чтобы не запрашивать чат перед каждой отправкой.
+    """
+
+    _STOP = object()
+
+    def __init__(self, max_attempts=BUYER_DELIVERY_MAX_ATTEMPTS, retry_delay=BUYER_DELIVERY_RETRY_DELAY):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._chat_ids = {}
+        self._chat_lock = threading.Lock()
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._drained = threading.Event()
+
+    def remember_chat(self, username, chat_id):
+        if username and chat_id:
+            with self._chat_lock:
+                self._chat_ids[username] = chat_id
+
+    def forget_chat(self, username):
+        with self._chat_lock:
+            self._chat_ids.pop(username, None)
+
+    def resolve_chat_id(self, c: Cardinal, username):
+        """chat_id покупателя из кэша, при промахе - через get_chat_by_name"""
+        with self._chat_lock:
+            chat_id = self._chat_ids.get(username)
+        if chat_id:
+            return chat_id
+
+        chat = c.account.get_chat_by_name(username, make_request=True)
+        if not chat:
+            return None
+        self.remember_chat(username, chat.id)
+        return chat.id
+
+    def enqueue(self, c: Cardinal, username, message, on_delivered=None):
+        self._schedule(time.monotonic(), {"cardinal": c, "username": username, "message": message, "attempt": 0,
+                                          "on_delivered": on_delivered})
+
+    def _schedule(self, due, entry):
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._counter), entry))
+            self._cond.notify()
+
+    def stop(self, timeout=BUYER_OUTBOX_DRAIN_TIMEOUT):
+        """Останавливает очередь и ждёт, пока оставшиеся сообщения будут отправлены по одному разу"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._drained.wait(timeout)
+
+    def _drain(self):
+        """
+        Одна попытка доставки для всего, что осталось в очереди при остановке. Недоставленные итоговые
+        сообщения по заказам не закрывают запись в журнале, поэтому номер будет выдан повторно после перезапуска.
+        """
+        with self._cond:
+            entries = [entry for _, _, entry in sorted(self._heap, key=lambda item: item[:2])]
+            self._heap = []
+        if entries:
+            logger.info(f"{LOGGER_PREFIX} Отправка {len(entries)} сообщений покупателям перед остановкой")
+        undelivered = sum(1 for entry in entries if not self._send(entry))
+        if undelivered:
+            logger.warning(f"{LOGGER_PREFIX} Не доставлено перед остановкой сообщений покупателям: {undelivered}")
+        self._drained.set()
+
+    def run(self):
+        """Цикл доставки, запускается в отдельном потоке"""
+        logger.info(f"{LOGGER_PREFIX} Запущена очередь сообщений покупателям")
+
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._heap:
+                        delay = self._heap[0][0] - time.monotonic()
+                        if delay <= 0:
+                            break
+                        self._cond.wait(delay)
+                    else:
+                        self._cond.wait()
+
+                if self._stopped:
+                    break
+
+                _, _, entry = heapq.heappop(self._heap)
+
+            self._deliver(entry)
+
+        self._drain()
+
+    def _send(self, entry):
+        """Одна попытка отправки; True, если сообщение доставлено"""
+        c, username = entry["cardinal"], entry["username"]
+        with metrics.span("buyer.deliver") as span:
+            try:
+                chat_id = self.resolve_chat_id(c, username)
+                if chat_id:
+                    c.account.send_message(chat_id, entry["message"], chat_name=username)
+                    logger.info(f"{LOGGER_PREFIX} Отправлено сообщение покупателю {username}")
+                    if entry.get("on_delivered"):
+                        entry["on_delivered"]()
+                    return True
+                logger.warning(f"{LOGGER_PREFIX} Не удалось найти чат с покупателем {username}")
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка при отправке сообщения покупателю {username}: {e}")
+                self.forget_chat(username)
+            span.fail()
+        return False
+
+    def _deliver(self, entry):
+        if self._send(entry):
+            return
+
+        username = entry["username"]
+        entry["attempt"] += 1
+        if entry["attempt"] >= self.max_attempts:
+            logger.error(
+                f"{LOGGER_PREFIX} Сообщение покупателю {username} не доставлено после {self.max_attempts} попыток")
+            notify_admins(f"⚠️ Не удалось доставить сообщение покупателю {username}:\n\n{entry['message']}")
+            return
+
+        self._schedule(time.monotonic() + self.retry_delay * 2 ** (entry["attempt"] - 1), entry)
+
+
+def send_message_to_buyer(c: Cardinal, username: str, message: str, on_delivered=None):
+    """Ставит сообщение покупателю в очередь доставки"""
+    buyer_outbox.enqueue(c, username, message, on_delivered)
+    return True
+
+
+def deliver_order_message(c: Cardinal, e: NewOrderEvent, message: str):
+    """Итоговое сообщение по заказу: запись в журнале закрывается только после его доставки"""
+    order_id = e.order.id
+    if not order_journal:
+        return send_message_to_buyer(c, e.order.buyer_username, message)
+    order_journal.defer(order_id)
+    return send_message_to_buyer(c, e.order.buyer_username, message,
+                                 on_delivered=lambda: order_journal.complete(order_id, delivered=True))
+
+
+class MetricSpan:
+    """Замер одного этапа: длительность пишется при выходе из блока, исключение считается ошибкой"""
+
+    def __init__(self, metrics, stage):
+        self._metrics = metrics
+        self._stage = stage
+        self._started = None
+        self.failed = False
+
+    def fail(self):
+        """Помечает этап как завершившийся ошибкой без выброса исключения"""
+        self.failed = True
+
+    def __enter__(self):
+        self._started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._metrics.record(self._stage, time.monotonic() - self._started, self.failed or exc_type is not None)
+        return False
+
+
+class StageMetrics:
+    """
+    Скользящие гистограммы длительности этапов обработки заказов и запросов к LZT Market.
+    По каждому этапу хранятся последние замеры для перцентилей и накопительные счётчики для экспорта.
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._stop_event = threading.Event()
+
+    def span(self, stage):
+        return MetricSpan(self, stage)
+
+    def record(self, stage, duration, error=False):
+        with self._lock:
+            data = self._stages.get(stage)
+            if data is None:
+                data = self._stages[stage] = {
+                    "samples": collections.deque(maxlen=self.window),
+                    "count": 0,
+                    "errors": 0,
+                    "sum": 0.0
+                }
+            data["samples"].append((duration, error))
+            data["count"] += 1
+            data["sum"] += duration
+            if error:
+                data["errors"] += 1
+
+    @staticmethod
+    def _quantile(sorted_values, q):
+        index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))
+        return sorted_values[index]
+
+    def snapshot(self):
+        """Перцентили и доля ошибок по окну, а также накопительные счётчики по каждому этапу"""
+        with self._lock:
+            raw = {stage: (list(data["samples"]), data["count"], data["errors"], data["sum"])
+                   for stage, data in self._stages.items()}
+
+        result = {}
+        for stage, (samples, count, errors, total) in sorted(raw.items()):
+            durations = sorted(duration for duration, _ in samples)
+            window_errors = sum(1 for _, error in samples if error)
+            result[stage] = {
+                "count": count,
+                "errors": errors,
+                "sum": total,
+                "window": len(samples),
+                "error_rate": window_errors / len(samples) if samples else 0.0,
+                "quantiles": {q: self._quantile(durations, q) for q in self.QUANTILES} if durations else {}
+            }
+        return result
+
+    def render_text(self):
+        """Сводка для команды /tg_stats"""
+        snapshot = self.snapshot()
+        if not snapshot:
+            return "📈 Замеров пока нет"
+
+        lines = ["📈 <b>Задержки этапов</b> (p50 / p95 / p99, мс)\n"]
+        for stage, data in snapshot.items():
+            q = data["quantiles"]
+            lines.append(
+                f"<code>{stage}</code>: {q[0.5] * 1000:.0f} / {q[0.95] * 1000:.0f} / {q[0.99] * 1000:.0f}, "
+                f"всего: {data['count']}, ошибок: {data['error_rate'] * 100:.1f}%"
+            )
+        return "\n".join(lines)
+
+    def render_prometheus(self):
+        """Метрики в текстовом формате Prometheus"""
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP tg_accounts_stage_duration_seconds Длительность этапов обработки по скользящему окну",
+            "# TYPE tg_accounts_stage_duration_seconds summary"
+        ]
+        for stage, data in snapshot.items():
+            for q, value in data["quantiles"].items():
+                lines.append(f'tg_accounts_stage_duration_seconds{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+            lines.append(f'tg_accounts_stage_duration_seconds_sum{{stage="{stage}"}} {data["sum"]:.6f}')
+            lines.append(f'tg_accounts_stage_duration_seconds_count{{stage="{stage}"}} {data["count"]}')
+
+        lines += [
+            "# HELP tg_accounts_stage_errors_total Количество этапов, завершившихся ошибкой",
+            "# TYPE tg_accounts_stage_errors_total counter"
+        ]
+        for stage, data in snapshot.items():
+            lines.append(f'tg_accounts_stage_errors_total{{stage="{stage}"}} {data["errors"]}')
+
+        if order_dispatcher:
+            stats = order_dispatcher.get_stats()
+            lines += [
+                "# TYPE tg_accounts_queue_depth gauge",
+                f"tg_accounts_queue_depth {stats['queue_depth']}",
+                "# TYPE tg_accounts_lane_queue_depth gauge",
+                *[f'tg_accounts_lane_queue_depth{{lane="{lane}"}} {size}' for lane, size in stats['lanes'].items()],
+                "# TYPE tg_accounts_in_flight gauge",
+                f"tg_accounts_in_flight {stats['in_flight']}",
+                "# TYPE tg_accounts_concurrency_limit gauge",
+                f"tg_accounts_concurrency_limit {stats['limit']}"
+            ]
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """Атомарно перезаписывает файл с метриками"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+    def run_exporter(self, path, interval=METRICS_EXPORT_INTERVAL):
+        """Периодическая выгрузка метрик в файл, запускается в отдельном потоке"""
+        while not self._stop_event.wait(interval):
+            try:
+                self.export(path)
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка при выгрузке метрик в {path}: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+
+
+metrics = StageMetrics()
+
+
+class TokenBucket:
+    """Token bucket с адаптивным темпом и паузой по требованию API"""
+
+    MIN_RATE_FACTOR = 0.25
+    RECOVERY_STEP = 0.05
+
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.rate_factor = 1.0
+        self.blocked_until = 0.0
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now <= self.updated_at:
+            return
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate * self.rate_factor)
+
+    def acquire(self):
+        """Блокирует поток, пока не появится свободный токен. Возвращает время ожидания"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    delay = (1 - self.tokens) / (self.rate * self.rate_factor)
+            time.sleep(delay)
+            waited += delay
+
+    def try_acquire(self, count):
+        """Забирает без ожидания до count свободных токенов. Возвращает, сколько удалось взять"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                return 0
+            taken = min(count, int(self.tokens))
+            self.tokens -= taken
+            return taken
+
+    def penalize(self, retry_after):
+        """API попросил подождать: пауза и мультипликативное снижение темпа"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            # После паузы пропускаем один повторный запрос, дальше темп восстанавливается с нуля
+            self.tokens = 1.0
+            self.updated_at = self.blocked_until
+            self.rate_factor = max(self.MIN_RATE_FACTOR, self.rate_factor / 2)
+
+    def reward(self):
+        """Успешный запрос: аддитивное восстановление темпа"""
+        with self._lock:
+            if self.rate_factor < 1.0:
+                self.rate_factor = min(1.0, self.rate_factor + self.RECOVERY_STEP)
+
+
+class RateLimiter:
+    """Общий для всех потоков ограничитель запросов к LZT Market по классам эндпоинтов"""
+
+    DEFAULT_RETRY_AFTER = 3.0
+
+    def __init__(self, limits):
+        self._buckets = {}
+        for endpoint, limit in dict(DEFAULT_RATE_LIMITS, **limits).items():
+            self._buckets[endpoint] = TokenBucket(limit["per_minute"], limit.get("burst", 1))
+
+    def acquire(self, endpoint):
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            return 0.0
+        waited = bucket.acquire()
+        if waited > 0:
+            logger.debug(f"{LOGGER_PREFIX} Ожидание лимита LZT для {endpoint}: {waited:.2f} сек.")
+        return waited
+
+    def try_acquire(self, endpoint, count):
+        """Неблокирующий вариант acquire для необязательных запросов: сколько из count можно выполнить сейчас"""
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            return count
+        return bucket.try_acquire(count)
+
+    def on_response(self, endpoint, response):
+        """Подстраивает темп под ответ API (429 / retry_request)"""
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            return
+
+        if not is_rate_limited_response(response):
+            bucket.reward()
+            return
+
+        retry_after = self.DEFAULT_RETRY_AFTER
+        try:
+            retry_after = float(response.headers.get("Retry-After", retry_after))
+        except (TypeError, ValueError):
+            pass
+
+        bucket.penalize(retry_after)
+        logger.warning(f"{LOGGER_PREFIX} LZT Market ограничил запросы {endpoint}, пауза {retry_after} сек.")
+
+
+def is_rate_limited_response(response):
+    """Проверяет, требует ли ответ LZT Market снизить частоту запросов"""
+    if response.status_code == 429:
+        return True
+    if response.status_code == 200:
+        return False
+    try:
+        errors = response.json().get("errors", [])
+    except (ValueError, AttributeError):
+        return False
+    return "retry_request" in errors
+
+
+class LztUnavailableError(Exception):
+    """LZT Market признан недоступным, запрос отклонён без обращения к API"""
+
+
+class LztPurchaseUnknownError(Exception):
+    """Запрос на покупку ушёл в LZT Market, но ответ не говорит, куплен ли аккаунт"""
+
+    def __init__(self, item_id, reason):
+        super().__init__(f"результат покупки аккаунта ID {item_id} неизвестен: {reason}")
+        self.item_id = item_id
+
+
+class CircuitBreaker:
+    """
+    Автомат защиты перед API LZT Market. После серии сетевых ошибок и ответов 5xx размыкается
+    и сразу отклоняет запросы, затем пропускает по одному пробному запросу (half-open).
+    Время до пробы удваивается после каждой неудачной пробы.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=LZT_BREAKER_FAILURE_THRESHOLD, open_timeout=LZT_BREAKER_OPEN_TIMEOUT,
+                 max_open_timeout=LZT_BREAKER_MAX_OPEN_TIMEOUT, on_open=None, on_close=None):
+        self.failure_threshold = failure_threshold
+        self.base_open_timeout = open_timeout
+        self.max_open_timeout = max_open_timeout
+        self.on_open = on_open
+        self.on_close = on_close
+        self._cond = threading.Condition()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._open_timeout = open_timeout
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._stopped = False
+
+    @property
+    def state(self):
+        with self._cond:
+            return self._state
+
+    def before_call(self):
+        """Разрешает запрос или выбрасывает LztUnavailableError, пока автомат разомкнут"""
+        with self._cond:
+            if self._state == self.CLOSED:
+                return
+            if (self._state == self.OPEN and not self._probe_in_flight
+                    and time.monotonic() >= self._opened_at + self._open_timeout):
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = True
+                logger.info(f"{LOGGER_PREFIX} Пробный запрос к LZT Market после размыкания автомата")
+                return
+            raise LztUnavailableError("LZT Market временно недоступен")
+
+    def on_success(self):
+        with self._cond:
+            self._failures = 0
+            if self._state != self.HALF_OPEN:
+                return
+            self._state = self.CLOSED
+            self._probe_in_flight = False
+            self._open_timeout = self.base_open_timeout
+        logger.info(f"{LOGGER_PREFIX} LZT Market снова доступен, автомат замкнут")
+        if self.on_close:
+            self.on_close()
+
+    def on_failure(self):
+        with self._cond:
+            if self._state == self.HALF_OPEN:
+                self._open_timeout = min(self._open_timeout * 2, self.max_open_timeout)
+            else:
+                self._failures += 1
+                if self._state == self.OPEN or self._failures < self.failure_threshold:
+                    return
+            just_opened = self._state == self.CLOSED
+            self._state = self.OPEN
+            self._probe_in_flight = False
+            self._opened_at = time.monotonic()
+            self._cond.notify_all()
+            timeout = self._open_timeout
+        logger.warning(f"{LOGGER_PREFIX} LZT Market недоступен, автомат разомкнут на {timeout:.0f} сек.")
+        if just_opened and self.on_open:
+            self.on_open()
+
+    def run(self, probe):
+        """Пробует API по истечении паузы, даже если заказов нет. Запускается в отдельном потоке"""
+        while True:
+            with self._cond:
+                while not self._stopped and self._state == self.CLOSED:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                delay = self._opened_at + self._open_timeout - time.monotonic()
+                if self._probe_in_flight:
+                    self._cond.wait(1.0)
+                    continue
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+            try:
+                probe()
+            except LztUnavailableError:
+                pass
+            except Exception as e:
+                logger.warning(f"{LOGGER_PREFIX} Пробный запрос к LZT Market не удался: {e}")
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+
+def on_lzt_breaker_open():
+    notify_admins("🔌 LZT Market недоступен. Запросы временно приостановлены, доступность проверяется автоматически.")
+
+
+def on_lzt_breaker_close():
+    notify_admins("✅ LZT Market снова доступен")
+    if order_dispatcher:
+        order_dispatcher.release_held()
+
+
+class LztClient:
+    """Клиент API LZT Market с общим пулом keep-alive соединений для всех потоков"""
+
+    def __init__(self, base_url=LZT_API_BASE, pool_size=LZT_POOL_SIZE, timeout=LZT_REQUEST_TIMEOUT,
+                 rate_limiter=None, breaker=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._token = None
+        self._headers = {}
+        self._stats = {}
+
+    def _auth_headers(self):
+        """Заголовки авторизации, пересобираются только при смене токена"""
+        token = config.get("lolz_token", "")
+        with self._lock:
+            if token != self._token:
+                self._token = token
+                self._headers = {
+                    "accept": "application/json",
+                    "authorization": f"Bearer {token}"
+                }
+            return self._headers
+
+    def _account(self, endpoint, status_code, elapsed):
+        """Учёт вызовов по каждому эндпоинту"""
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {"calls": 0, "errors": 0, "total_time": 0.0})
+            stats["calls"] += 1
+            stats["total_time"] += elapsed
+            if status_code != 200:
+                stats["errors"] += 1
+
+    def request(self, endpoint, method, path, params=None, rate_acquired=False):
+        """Выполняет запрос к API через общую сессию. rate_acquired - токен лимита уже взят вызывающим"""
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        if self.breaker:
+            self.breaker.before_call()
+        if self.rate_limiter and not rate_acquired:
+            with metrics.span(f"lzt.{endpoint}.rate_wait"):
+                self.rate_limiter.acquire(endpoint)
+
+        started = time.monotonic()
+        try:
+            response = self.session.request(
+                method, url, params=params, headers=self._auth_headers(), timeout=self.timeout
+            )
+        except Exception:
+            elapsed = time.monotonic() - started
+            self._account(endpoint, None, elapsed)
+            metrics.record(f"lzt.{endpoint}", elapsed, error=True)
+            if self.breaker:
+                self.breaker.on_failure()
+            if self._feeds_concurrency(endpoint):
+                order_dispatcher.on_lzt_response(endpoint, elapsed, congested=True)
+            raise
+        elapsed = time.monotonic() - started
+        self._account(endpoint, response.status_code, elapsed)
+        metrics.record(f"lzt.{endpoint}", elapsed, error=response.status_code != 200)
+        if self.breaker:
+            if response.status_code >= 500:
+                self.breaker.on_failure()
+            else:
+                self.breaker.on_success()
+        if self.rate_limiter:
+            self.rate_limiter.on_response(endpoint, response)
+        if self._feeds_concurrency(endpoint):
+            order_dispatcher.on_lzt_response(
+                endpoint, elapsed, congested=response.status_code >= 500 or is_rate_limited_response(response))
+        return response
+
+    @staticmethod
+    def _feeds_concurrency(endpoint):
+        """Задержки и перегрузка учитываются в лимите заказов только для поиска и покупки из потока заказа"""
+        return (order_dispatcher is not None and endpoint in CONCURRENCY_FEEDBACK_ENDPOINTS
+                and getattr(order_worker_context, "active", False))
+
+    def search_telegram(self, params):
+        return self.request("search", "GET", "telegram", params=params)
+
+    def fast_buy(self, item_id):
+        return self.request("fast_buy", "POST", f"{item_id}/fast-buy")
+
+    def telegram_login_code(self, item_id):
+        return self.request("login_code", "GET", f"{item_id}/telegram-login-code")
+
+    def get_item(self, item_id, rate_acquired=False):
+        return self.request("item", "GET", f"{item_id}", rate_acquired=rate_acquired)
+
+    def purchase_history(self, page=1):
+        """Купленные аккаунты Telegram, страница истории покупок"""
+        return self.request("history", "GET", "user/orders",
+                            params={"category_id": LZT_TELEGRAM_CATEGORY_ID, "page": page})
+
+    def probe(self):
+        """Лёгкий запрос для проверки доступности API"""
+        return self.request("item", "GET", "me")
+
+    def get_stats(self):
+        """Снимок статистики вызовов по эндпоинтам"""
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
+
+    def close(self):
+        self.session.close()
+
+
+def build_search_params(min_price, max_price, country_codes):
+    """Параметры поиска Telegram-аккаунтов для одной или нескольких стран"""
+    params = [("order_by", "price_to_up"), ("pmin", min_price), ("pmax", max_price)]
+
+    for origin in config["origins"]:
+        params.append(("origin[]", origin))
+
+    params += [
+        ("spam", "no"),
+        ("allow_geo_spamblock", "true"),
+        ("password", "no")
+    ]
+
+    for country_code in country_codes:
+        params.append(("country[]", country_code))
+
+    return params
+
+
+def find_available_accounts(country_code, min_price, max_price):
+    """Поиск доступных аккаунтов с сортировкой по возрастанию цены"""
+    available_accounts = []
+
+    try:
+        params = build_search_params(min_price, max_price, [country_code])
+
+        response = lzt_client.search_telegram(params)
+        logger.info(f"{LOGGER_PREFIX} Запрос к API LOLZ Market: {response.url}")
+
+        if response.status_code >= 500:
+            raise LztUnavailableError(f"LZT Market вернул {response.status_code}")
+
+        if response.status_code == 200:
+            response_data = response.json()
+
+            if 'items' in response_data and response_data['items']:
+                items = response_data['items']
+                logger.info(f"{LOGGER_PREFIX} Найдено {len(items)} аккаунтов")
+                available_accounts = items
+            else:
+                logger.info(f"{LOGGER_PREFIX} Нет доступных аккаунтов")
+        else:
+            logger.error(f"{LOGGER_PREFIX} Ошибка запроса к API LOLZ Market: {response.status_code}, {response.text}")
+
+    except LztUnavailableError:
+        raise
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка при поиске аккаунтов: {e}")
+
+    logger.info(f"{LOGGER_PREFIX} Всего найдено {len(available_accounts)} доступных аккаунтов")
+    return available_accounts
+
+
+def get_item_country(item):
+    """Код страны лота из выдачи поиска"""
+    country = item.get('telegram_country') or item.get('country')
+    return str(country).upper() if country else None
+
+
+def find_available_accounts_batch(countries):
+    """
+    Один поиск сразу по нескольким странам (countries: код -> данные страны из конфига).
+    Выдача раскладывается по стране лота и фильтруется ценовыми границами каждой страны,
+    порядок по возрастанию цены сохраняется. Если LZT вернул не все лоты, пустая корзина
+    ничего не говорит о наличии, и такие страны в результат не попадают. Если у части лотов
+    страну определить не удалось, недостоверна вся выдача, и возвращается пустой словарь.
+    """
+    by_code = {code.upper(): code for code in countries}
+    min_price = min(data['min_price'] for data in countries.values())
+    max_price = max(data['max_price'] for data in countries.values())
+
+    try:
+        response = lzt_client.search_telegram(build_search_params(min_price, max_price, list(countries)))
+        logger.info(f"{LOGGER_PREFIX} Пакетный запрос к API LOLZ Market: {response.url}")
+
+        if response.status_code >= 500:
+            raise LztUnavailableError(f"LZT Market вернул {response.status_code}")
+
+        if response.status_code != 200:
+            logger.error(f"{LOGGER_PREFIX} Ошибка запроса к API LOLZ Market: {response.status_code}, {response.text}")
+            return {}
+
+        response_data = response.json()
+    except LztUnavailableError:
+        raise
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка при пакетном поиске аккаунтов: {e}")
+        return {}
+
+    items = response_data.get('items') or []
+    buckets = {code: [] for code in countries}
+    unmatched = 0
+    for item in items:
+        code = by_code.get(get_item_country(item))
+        if code is None:
+            unmatched += 1
+            continue
+        try:
+            price = float(item.get('price', 0))
+        except (TypeError, ValueError):
+            continue
+        if countries[code]['min_price'] <= price <= countries[code]['max_price']:
+            buckets[code].append(item)
+
+    if unmatched:
+        logger.warning(
+            f"{LOGGER_PREFIX} Пакетный поиск: у {unmatched} из {len(items)} аккаунтов не определена страна, "
+            f"используем поиск по каждой стране")
+        return {}
+
+    total = response_data.get('totalItems')
+    if not isinstance(total, int) or total > len(items):
+        buckets = {code: accounts for code, accounts in buckets.items() if accounts}
+
+    logger.info(
+        f"{LOGGER_PREFIX} Пакетный поиск по {len(countries)} странам: {len(items)} аккаунтов, "
+        f"достоверно для {len(buckets)} стран")
+    return buckets
+
+
+class InventoryCache:
+    """Фоновый прогрев отсортированных по цене списков аккаунтов для настроенных стран"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+
+    def get(self, country_code, min_price, max_price):
+        """Свежий список кандидатов или None, если кэш пуст или устарел"""
+        max_age = config.get("prefetch_max_age", DEFAULT_PREFETCH_MAX_AGE)
+        with self._lock:
+            entry = self._entries.get(country_code)
+            if not entry or not entry["accounts"]:
+                return None
+            if (entry["min_price"], entry["max_price"]) != (min_price, max_price):
+                return None
+            if time.monotonic() - entry["fetched_at"] > max_age:
+                return None
+            return list(entry["accounts"])
+
+    def put(self, country_code, accounts, min_price, max_price):
+        with self._lock:
+            self._entries[country_code] = {
+                "accounts": list(accounts),
+                "min_price": min_price,
+                "max_price": max_price,
+                "fetched_at": time.monotonic()
+            }
+
+    def discard(self, country_code, item_id):
+        """Убирает купленный аккаунт из кэша, чтобы другие заказы его не пробовали"""
+        self.discard_many(country_code, (item_id,))
+
+    def discard_many(self, country_code, item_ids):
+        """Убирает из кэша страны аккаунты, которые не удалось купить или не прошли проверку"""
+        item_ids = set(item_ids)
+        if not item_ids:
+            return
+        with self._lock:
+            entry = self._entries.get(country_code)
+            if entry:
+                entry["accounts"] = [a for a in entry["accounts"] if a.get('item_id') not in item_ids]
+
+    def refresh_all(self):
+        countries = dict(config["countries"])
+        with self._lock:
+            for code in list(self._entries):
+                if code not in countries:
+                    del self._entries[code]
+
+        try:
+            batch_size = max(1, int(config.get("prefetch_batch_size", DEFAULT_PREFETCH_BATCH_SIZE)))
+        except (TypeError, ValueError):
+            batch_size = DEFAULT_PREFETCH_BATCH_SIZE
+        # Соседние по цене страны в одном пакете меньше вытесняют друг друга из страницы выдачи
+        codes = sorted(countries, key=lambda code: (countries[code]['min_price'], countries[code]['max_price']))
+
+        for start in range(0, len(codes), batch_size):
+            if self._stop.is_set():
+                return
+            batch = {code: countries[code] for code in codes[start:start + batch_size]}
+            buckets = find_available_accounts_batch(batch) if len(batch) > 1 else {}
+
+            for code, country_data in batch.items():
+                accounts = buckets.get(code)
+                if accounts is None:
+                    if self._stop.is_set():
+                        return
+                    accounts = find_available_accounts(code, country_data['min_price'], country_data['max_price'])
+                self.put(code, accounts, country_data['min_price'], country_data['max_price'])
+
+    def run(self):
+        """Цикл прогрева, запускается в отдельном потоке"""
+        logger.info(f"{LOGGER_PREFIX} Запущена фоновая предзагрузка аккаунтов")
+
+        while not self._stop.is_set():
+            try:
+                if config.get("prefetch_enabled", True) and config["lolz_token"]:
+                    self.refresh_all()
+            except LztUnavailableError:
+                logger.info(f"{LOGGER_PREFIX} Предзагрузка аккаунтов пропущена: LZT Market недоступен")
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка при предзагрузке аккаунтов: {e}")
+
+            self._wakeup.wait(config.get("prefetch_interval", DEFAULT_PREFETCH_INTERVAL))
+            self._wakeup.clear()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+
+def acquire_account(country_code, min_price, max_price, order_id=None):
+    """
+    Покупка аккаунта для страны: сначала из прогретого кэша, затем через живой поиск.
+    Возвращает результат покупки, данные аккаунта, признак нехватки средств и список кандидатов.
+    """
+    cached_accounts = inventory_cache.get(country_code, min_price, max_price) if inventory_cache else None
+    # Лоты, отброшенные проверкой или отказавшие в покупке: убираются из кэша и не пробуются повторно
+    rejected = set()
+
+    if cached_accounts:
+        logger.info(f"{LOGGER_PREFIX} Используем {len(cached_accounts)} аккаунтов из кэша для страны {country_code}")
+        purchase_result, account_data, funds_issue = try_purchase_accounts(cached_accounts, order_id, rejected)
+        inventory_cache.discard_many(country_code, rejected)
+
+        if purchase_result and 'item' in purchase_result:
+            inventory_cache.discard(country_code, purchase_result['item'].get('item_id'))
+            return purchase_result, account_data, funds_issue, cached_accounts
+
+        if funds_issue:
+            return purchase_result, account_data, funds_issue, cached_accounts
+
+        logger.info(f"{LOGGER_PREFIX} Аккаунты из кэша для страны {country_code} недоступны, выполняем живой поиск")
+
+    logger.info(f"{LOGGER_PREFIX} Поиск аккаунтов для страны {country_code}")
+    with metrics.span("order.search"):
+        available_accounts = find_available_accounts(country_code, min_price, max_price)
+    if rejected:
+        available_accounts = [a for a in available_accounts if a.get('item_id') not in rejected]
+
+    if not available_accounts:
+        return None, None, False, available_accounts
+
+    logger.info(f"{LOGGER_PREFIX} Найдено {len(available_accounts)} аккаунтов")
+    purchase_result, account_data, funds_issue = try_purchase_accounts(available_accounts, order_id, rejected)
+
+    if inventory_cache and purchase_result and 'item' in purchase_result:
+        # Свежая выдача поиска без купленного и отказавших аккаунтов пригодится следующим заказам
+        rejected.add(purchase_result['item'].get('item_id'))
+        inventory_cache.put(country_code, [a for a in available_accounts if a.get('item_id') not in rejected],
+                            min_price, max_price)
+
+    return purchase_result, account_data, funds_issue, available_accounts
+
+
+def check_account_available(item_id, rate_acquired=False):
+    """Лёгкая проверка лота: True - активен, False - продан или снят, None - проверить не удалось"""
+    try:
+        response = lzt_client.get_item(item_id, rate_acquired=rate_acquired)
+        if response.status_code == 404:
+            return False
+        if response.status_code != 200:
+            return None
+        item = response.json().get('item', {})
+        return item.get('item_state', 'active') == 'active'
+    except Exception as e:
+        logger.warning(f"{LOGGER_PREFIX} Не удалось проверить аккаунт ID {item_id}: {e}")
+        return None
+
+
+def get_prevalidate_count():
+    """Число проверяемых кандидатов из настроек, ограниченное размером пула проверок"""
+    try:
+        count = int(config.get("prevalidate_count", DEFAULT_PREVALIDATE_COUNT))
+    except (TypeError, ValueError):
+        count = DEFAULT_PREVALIDATE_COUNT
+    return max(0, min(count, PREVALIDATE_MAX_WORKERS))
+
+
+def prevalidate_accounts(accounts, rejected=None):
+    """
+    Параллельно проверяет первые кандидаты и отбрасывает уже недоступные лоты.
+    ID отброшенных лотов добавляются в rejected, если он передан.
+    """
+    count = get_prevalidate_count()
+    if count <= 0 or len(accounts) < 2 or not validation_executor:
+        return accounts
+
+    # Проверка не должна ждать лимит item: берём только токены, свободные прямо сейчас
+    if lzt_rate_limiter:
+        count = lzt_rate_limiter.try_acquire("item", min(count, len(accounts)))
+        if count <= 0:
+            logger.debug(f"{LOGGER_PREFIX} Лимит запросов item исчерпан, предварительная проверка пропущена")
+            return accounts
+
+    head, tail = accounts[:count], accounts[count:]
+    statuses = list(validation_executor.map(
+        lambda account: check_account_available(account.get('item_id'), rate_acquired=True), head))
+    live = [account for account, status in zip(head, statuses) if status is not False]
+    if rejected is not None:
+        rejected.update(account.get('item_id') for account, status in zip(head, statuses) if status is False)
+
+    dropped = len(head) - len(live)
+    if dropped:
+        logger.info(f"{LOGGER_PREFIX} Предварительная проверка отбросила {dropped} недоступных аккаунтов из {len(head)}")
+
+    return live + tail
+
+
+def try_purchase_accounts(accounts, order_id=None, rejected=None):
+    """
+    Пытается купить аккаунты из списка по очереди, пока не найдет доступный.
+    В rejected, если он передан, собираются ID лотов, отброшенных проверкой или отказавших в покупке.
+    """
+    insufficient_funds = False
+
+    # Проверка доступности идёт параллельно, а сами покупки остаются строго последовательными
+    with metrics.span("order.prevalidate"):
+        accounts = prevalidate_accounts(accounts, rejected)
+
+    for account in accounts:
+        item_id = account.get('item_id')
+        price = account.get('price')
+        logger.info(f"{LOGGER_PREFIX} Попытка покупки аккаунта ID: {item_id}, цена: {price}₽")
+
+        if order_id is not None:
+            # Отметка до запроса: если процесс упадёт во время покупки, повтор из журнала не купит второй аккаунт
+            order_store.set_order_state(order_id, ORDER_STATE_BUYING, item_id)
+
+        with metrics.span("order.fast_buy_attempt") as span:
+            purchase_result = purchase_account(item_id)
+            if not purchase_result or 'item' not in purchase_result:
+                span.fail()
+
+        if purchase_result and 'item' in purchase_result:
+            login_data = purchase_result['item'].get('loginData', {})
+            login = login_data.get('login', '')
+            password = login_data.get('password', '')
+            telegram_id = purchase_result['item'].get('telegram_id', '')
+            telegram_phone = purchase_result['item'].get('telegram_phone', '')
+            telegram_username = purchase_result['item'].get('telegram_username', '')
+
+            account_data = {
+                'login': login,
+                'password': password,
                 'telegram_id': telegram_id,
                 'telegram_phone': telegram_phone,
                 'telegram_username': telegram_username
@@ -1505,27 +3593,56 @@ def try_purchase_accounts(accounts):
                 logger.error(f"{LOGGER_PREFIX} Критическая ошибка при покупке аккаунта: {error_msg}")
                 break
             else:
+                if rejected is not None:
+                    rejected.add(item_id)
                 logger.info(f"{LOGGER_PREFIX} Игнорируем ошибку и пробуем следующий аккаунт")
 
     return None, None, insufficient_funds
 
 
-def purchase_account(item_id):
-    """Покупка аккаунта по ID"""
+def find_purchased_item(item_id):
+    """Лот из первой страницы истории покупок LZT Market или None"""
+    response = lzt_client.purchase_history(1)
+    if response.status_code != 200:
+        raise LztUnavailableError(f"LZT Market вернул {response.status_code}")
+    for item in response.json().get("items") or []:
+        if str(item.get("item_id")) == str(item_id):
+            return item
+    return None
+
+
+def resolve_unknown_purchase(item_id, reason):
+    """
+    Ответ на fast-buy потерян или 5xx: покупка могла пройти. Проверяем историю покупок, а если
+    аккаунта там нет или история недоступна, повторять покупку нельзя - выбрасываем LztPurchaseUnknownError.
+    """
+    logger.warning(f"{LOGGER_PREFIX} Неизвестен результат покупки аккаунта ID {item_id} ({reason}), проверяем историю покупок")
     try:
-        timer = threading.Timer(3.0, lambda: None)
-        timer.start()
-        timer.join()
+        item = find_purchased_item(item_id)
+    except Exception as e:
+        raise LztPurchaseUnknownError(item_id, f"{reason}, история покупок недоступна: {e}")
 
-        url = f"https://prod-api.lzt.market/{item_id}/fast-buy"
+    if item is None:
+        raise LztPurchaseUnknownError(item_id, f"{reason}, аккаунта нет в истории покупок")
 
-        headers = {
-            "accept": "application/json",
-            "authorization": f"Bearer {config['lolz_token']}"
-        }
+    logger.info(f"{LOGGER_PREFIX} Покупка аккаунта ID {item_id} подтверждена по истории покупок")
+    return {"item": item}
 
-        response = requests.post(url, headers=headers)
-        logger.info(f"{LOGGER_PREFIX} Запрос на покупку аккаунта ID {item_id}: {url}")
+
+def purchase_account(item_id):
+    """Покупка аккаунта по ID"""
+    try:
+        try:
+            response = lzt_client.fast_buy(item_id)
+        except LztUnavailableError:
+            # Автомат разомкнут, запрос не отправлялся
+            raise
+        except requests.RequestException as e:
+            return resolve_unknown_purchase(item_id, str(e))
+        logger.info(f"{LOGGER_PREFIX} Запрос на покупку аккаунта ID {item_id}: {response.url}")
+
+        if response.status_code >= 500:
+            return resolve_unknown_purchase(item_id, f"LZT Market вернул {response.status_code}")
 
         if response.status_code == 200:
             result = response.json()
@@ -1536,19 +3653,145 @@ def purchase_account(item_id):
             logger.error(f"{LOGGER_PREFIX} Ошибка при покупке аккаунта: {response.status_code}, {str(result)}")
             return result
 
+    except (LztUnavailableError, LztPurchaseUnknownError):
+        raise
     except Exception as e:
         logger.error(f"{LOGGER_PREFIX} Исключение при покупке аккаунта {item_id}: {e}")
         return {"errors": [str(e)]}
 
 
-def notify_admins(message, order_id=None):
-    """Отправка уведомления администраторам"""
+class AdminNotifier:
+    """
+    Очередь уведомлений администраторам с отдельным потоком отправки.
+    Соблюдает лимиты Telegram на чат и собирает низкоприоритетные уведомления в сводку.
+    """
+
+    _STOP = object()
+
+    def __init__(self, chat_interval=ADMIN_CHAT_INTERVAL, global_interval=ADMIN_GLOBAL_INTERVAL,
+                 digest_window=ADMIN_DIGEST_WINDOW):
+        self.chat_interval = chat_interval
+        self.global_interval = global_interval
+        self.digest_window = digest_window
+        self._queue = queue.Queue()
+        self._digest_lock = threading.Lock()
+        self._digest = []
+        self._digest_deadline = None
+        self._last_chat_send = {}
+        self._last_global_send = 0.0
+
+    def enqueue(self, message, order_id=None, low_priority=False):
+        if not low_priority:
+            self._queue.put((message, order_id))
+            return
+
+        with self._digest_lock:
+            self._digest.append((message, order_id))
+            if self._digest_deadline is None:
+                self._digest_deadline = time.monotonic() + self.digest_window
+
+    def stop(self):
+        self._queue.put(self._STOP)
+
+    def run(self):
+        """Цикл отправки, запускается в отдельном потоке"""
+        logger.info(f"{LOGGER_PREFIX} Запущена очередь уведомлений администраторам")
+
+        while True:
+            with self._digest_lock:
+                deadline = self._digest_deadline
+            timeout = max(0.0, deadline - time.monotonic()) if deadline is not None else self.digest_window
+
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self._STOP:
+                self._flush_digest(force=True)
+                return
+
+            if item is not None:
+                self._deliver(*item)
+
+            self._flush_digest()
+
+    def _flush_digest(self, force=False):
+        with self._digest_lock:
+            if not self._digest:
+                return
+            if not force and time.monotonic() < self._digest_deadline:
+                return
+            entries, self._digest, self._digest_deadline = self._digest, [], None
+
+        if len(entries) == 1:
+            self._deliver(*entries[0])
+            return
+
+        lines = [f"• {message}" for message, _ in entries[:ADMIN_DIGEST_MAX_LINES]]
+        if len(entries) > ADMIN_DIGEST_MAX_LINES:
+            lines.append(f"…и ещё {len(entries) - ADMIN_DIGEST_MAX_LINES}")
+        self._deliver(f"📋 Сводка уведомлений ({len(entries)}):\n\n" + "\n".join(lines))
+
+    def _throttle(self, admin_id):
+        now = time.monotonic()
+        ready_at = max(
+            self._last_chat_send.get(admin_id, 0.0) + self.chat_interval,
+            self._last_global_send + self.global_interval
+        )
+        if ready_at > now:
+            time.sleep(ready_at - now)
+        now = time.monotonic()
+        self._last_chat_send[admin_id] = now
+        self._last_global_send = now
+
+    def _deliver(self, message, order_id=None):
+        kb = None
+        if order_id:
+            kb = InlineKeyboardMarkup()
+            kb.add(InlineKeyboardButton("Перейти к заказу", url=f"https://funpay.com/orders/{order_id}/"))
+
+        for admin_id in list(config["administrators"]):
+            for attempt in range(2):
+                self._throttle(admin_id)
+                started = time.monotonic()
+                try:
+                    bot.send_message(admin_id, message, reply_markup=kb)
+                    metrics.record("admin.send", time.monotonic() - started)
+                    logger.info(f"{LOGGER_PREFIX} Отправлено уведомление администратору {admin_id}")
+                    break
+                except Exception as e:
+                    metrics.record("admin.send", time.monotonic() - started, error=True)
+                    retry_after = self._retry_after(e)
+                    if attempt == 0 and retry_after:
+                        logger.warning(f"{LOGGER_PREFIX} Telegram ограничил отправку, повтор через {retry_after} сек.")
+                        time.sleep(retry_after)
+                        continue
+                    logger.error(f"{LOGGER_PREFIX} Ошибка при отправке уведомления администратору {admin_id}: {e}")
+                    break
+
+    @staticmethod
+    def _retry_after(error):
+        """Время ожидания из ответа Telegram 429, если ошибка связана с лимитом"""
+        if getattr(error, "error_code", None) != 429:
+            return None
+        try:
+            return float(error.result_json["parameters"]["retry_after"])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return ADMIN_CHAT_INTERVAL
+
+
+def notify_admins(message, order_id=None, low_priority=False):
+    """
+    Постановка уведомления администраторам в очередь отправки.
+    Низкоприоритетные уведомления объединяются в сводку.
+    """
     if not config["administrators"]:
         logger.warning(f"{LOGGER_PREFIX} Нет настроенных администраторов для уведомлений")
         return
 
-    if order_id and order_id in config["orders_profit"]:
-        profit_data = config["orders_profit"][order_id]
+    profit_data = get_order_profit(order_id) if order_id else None
+    if profit_data:
         profit_info = (
             f"\n💰 Финансовая информация:\n"
             f"• Сумма на FP: {profit_data.get('fp_sum', 0)} руб.\n"
@@ -1557,72 +3800,328 @@ def notify_admins(message, order_id=None):
         )
         message += profit_info
 
-    for admin_id in config["administrators"]:
-        try:
-            if order_id:
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("Перейти к заказу", url=f"https://funpay.com/orders/{order_id}/"))
-                bot.send_message(admin_id, message, reply_markup=kb)
-            else:
-                bot.send_message(admin_id, message)
-            logger.info(f"{LOGGER_PREFIX} Отправлено уведомление администратору {admin_id}")
-        except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Ошибка при отправке уведомления администратору {admin_id}: {e}")
+    admin_notifier.enqueue(message, order_id, low_priority)
 
 
-def get_telegram_codes(item_id):
-    """Получает коды входа в Telegram аккаунт по ID предмета"""
-    max_retries = 10
-    retry_delay = 3
+def fetch_telegram_codes(item_id):
+    """Один запрос кодов входа в Telegram аккаунт. Возвращает ответ API или None, если стоит повторить"""
+    try:
+        response = lzt_client.telegram_login_code(item_id)
+        logger.info(
+            f"{LOGGER_PREFIX} Запрос кодов для аккаунта ID {item_id}: {response.url}, статус: {response.status_code}")
+
+        if response.status_code == 200:
+            result = response.json()
+            logger.info(f"{LOGGER_PREFIX} Получены коды для аккаунта ID {item_id}")
+            return result
 
-    for attempt in range(max_retries):
         try:
-            if attempt > 0:
-                time.sleep(retry_delay * attempt)
-                logger.info(
-                    f"{LOGGER_PREFIX} Повторная попытка {attempt + 1}/{max_retries} получения кодов для аккаунта ID {item_id}")
+            result = response.json()
 
-            url = f"https://prod-api.lzt.market/{item_id}/telegram-login-code"
+            if 'errors' in result and 'retry_request' in result['errors']:
+                logger.info(f"{LOGGER_PREFIX} Получена ошибка retry_request, повторим запрос")
+                return None
 
-            headers = {
-                "accept": "application/json",
-                "authorization": f"Bearer {config['lolz_token']}"
-            }
+            logger.error(f"{LOGGER_PREFIX} Ошибка при получении кодов: {response.status_code}, {str(result)}")
+        except ValueError:
+            logger.error(
+                f"{LOGGER_PREFIX} Ошибка при получении кодов: {response.status_code}, невозможно распарсить ответ")
 
-            response = requests.get(url, headers=headers)
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Исключение при получении кодов для аккаунта {item_id}: {e}")
+
+    return None
+
+
+class CodePoller:
+    """
+    Планировщик опроса кодов входа. Ожидающие запросы хранятся в куче с временем следующей попытки,
+    поэтому между повторами ни один поток не спит ради конкретного покупателя.
+    Запросы по одному item_id объединяются в один опрос, полученный код кэшируется на CODE_CACHE_TTL.
+    """
+
+    STARTED = "started"
+    JOINED = "joined"
+    DUPLICATE = "duplicate"
+    CACHED = "cached"
+
+    def __init__(self, max_attempts=CODE_POLL_MAX_ATTEMPTS, retry_delay=CODE_POLL_RETRY_DELAY,
+                 workers=CODE_POLL_WORKERS, cache_ttl=CODE_CACHE_TTL):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.cache_ttl = cache_ttl
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._inflight = {}
+        self._cache = {}
+        self._stopped = False
+
+    def _cached(self, item_id, now):
+        cached = self._cache.get(item_id)
+        if cached and cached[0] > now:
+            return cached[1]
+        self._cache.pop(item_id, None)
+        return None
+
+    def lookup(self, item_id, key=None):
+        """Состояние запроса без его постановки: CACHED, DUPLICATE, JOINED или None, если опроса нет"""
+        with self._cond:
+            if self._cached(item_id, time.monotonic()) is not None:
+                return self.CACHED
+            entry = self._inflight.get(item_id)
+            if entry is None:
+                return None
+            return self.DUPLICATE if key is not None and key in entry["keys"] else self.JOINED
+
+    def request(self, item_id, callback, key=None):
+        """
+        Ставит запрос кодов в расписание. callback(codes_data) вызывается с ответом API или None.
+        Повторный запрос с тем же key (например, chat_id), пока опрос идёт, не добавляет второго получателя.
+        """
+        now = time.monotonic()
+        with self._cond:
+            cached = self._cached(item_id, now)
+            if cached is None:
+                entry = self._inflight.get(item_id)
+                if entry is not None:
+                    if key is not None and key in entry["keys"]:
+                        return self.DUPLICATE
+                    entry["callbacks"].append(callback)
+                    if key is not None:
+                        entry["keys"].add(key)
+                    return self.JOINED
+
+                entry = {"item_id": item_id, "attempt": 0, "callbacks": [callback],
+                         "keys": {key} if key is not None else set(), "requested_at": now}
+                self._inflight[item_id] = entry
+
+        if cached is not None:
+            metrics.record("code.total", 0.0)
+            self._executor.submit(self._notify, item_id, [callback], cached)
+            return self.CACHED
+
+        self._schedule(now, entry)
+        return self.STARTED
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _schedule(self, due, entry):
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._counter), entry))
+            self._cond.notify()
+
+    def run(self):
+        """Цикл планировщика, запускается в отдельном потоке"""
+        logger.info(f"{LOGGER_PREFIX} Запущен планировщик запросов кодов")
+
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._heap:
+                        delay = self._heap[0][0] - time.monotonic()
+                        if delay <= 0:
+                            break
+                        self._cond.wait(delay)
+                    else:
+                        self._cond.wait()
+
+                if self._stopped:
+                    return
+
+                _, _, entry = heapq.heappop(self._heap)
+
+            try:
+                self._executor.submit(self._poll, entry)
+            except RuntimeError:
+                return
+
+    def _poll(self, entry):
+        item_id = entry["item_id"]
+        attempt = entry["attempt"]
+        if attempt > 0:
             logger.info(
-                f"{LOGGER_PREFIX} Запрос кодов для аккаунта ID {item_id}: {url}, статус: {response.status_code}")
+                f"{LOGGER_PREFIX} Повторная попытка {attempt + 1}/{self.max_attempts} получения кодов для аккаунта ID {item_id}")
 
-            if response.status_code == 200:
-                result = response.json()
-                logger.info(f"{LOGGER_PREFIX} Получены коды для аккаунта ID {item_id}")
-                return result
-            else:
-                try:
-                    result = response.json()
+        with metrics.span("code.fetch") as span:
+            result = fetch_telegram_codes(item_id)
+            if result is None:
+                span.fail()
 
-                    if 'errors' in result and 'retry_request' in result['errors']:
-                        logger.info(f"{LOGGER_PREFIX} Получена ошибка retry_request, повторим запрос")
-                        continue
+        if result is None and attempt + 1 < self.max_attempts:
+            entry["attempt"] = attempt + 1
+            self._schedule(time.monotonic() + self.retry_delay * entry["attempt"], entry)
+            return
 
-                    logger.error(f"{LOGGER_PREFIX} Ошибка при получении кодов: {response.status_code}, {str(result)}")
-                except ValueError:
-                    logger.error(
-                        f"{LOGGER_PREFIX} Ошибка при получении кодов: {response.status_code}, невозможно распарсить ответ")
+        now = time.monotonic()
+        metrics.record("code.total", now - entry["requested_at"], error=result is None)
+        with self._cond:
+            self._inflight.pop(item_id, None)
+            if result and result.get("codes"):
+                self._cache[item_id] = (now + self.cache_ttl, result)
+                for cached_id in [i for i, (expires_at, _) in self._cache.items() if expires_at <= now]:
+                    del self._cache[cached_id]
+            callbacks = list(entry["callbacks"])
+
+        self._notify(item_id, callbacks, result)
+
+    @staticmethod
+    def _notify(item_id, callbacks, result):
+        for callback in callbacks:
+            try:
+                callback(result)
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике кодов для аккаунта ID {item_id}: {e}")
 
-                if attempt == max_retries - 1:
-                    return None
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._executor.shutdown(wait=False)
 
-        except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Исключение при получении кодов для аккаунта {item_id}: {e}")
-            if attempt == max_retries - 1:
+
+def deliver_login_code(c: Cardinal, chat_id, chat_name, user_id, phone_number, item_id, found_order_id, codes_data):
+    """Отправляет покупателю полученный код, вызывается планировщиком после опроса LZT"""
+    try:
+        if not codes_data or 'codes' not in codes_data or not codes_data['codes']:
+            c.account.send_message(
+                chat_id,
+                f"❌ Не удалось получить код для номера {phone_number}. Код может появиться через несколько минут, попробуйте позже.",
+                chat_name=chat_name
+            )
+            notify_admins(f"⚠️ Не удалось получить код для номера {phone_number}, item_id: {item_id}", found_order_id)
+            return
+
+        latest_code = codes_data['codes'][0]['code']
+
+        code_template = config.get("code_template", DEFAULT_CODE_TEMPLATE)
+
+        order_link = f"https://funpay.com/orders/{found_order_id}/"
+        message_text = code_template.format(
+            code=latest_code,
+            order_link=order_link,
+            order_id=found_order_id
+        )
+
+        c.account.send_message(chat_id, message_text, chat_name=chat_name)
+
+        if order_store.add_order(user_id, found_order_id, phone_number, item_id, replace=False):
+            order_index.upsert(found_order_id)
+
+        logger.info(f"{LOGGER_PREFIX} Успешно отправлен код для номера {phone_number} пользователю {user_id}")
+
+    except Exception as ex:
+        logger.error(f"{LOGGER_PREFIX} Ошибка при отправке кода: {ex}")
+        try:
+            c.account.send_message(
+                chat_id,
+                "❌ Произошла техническая ошибка при получении кода. Попробуйте позже или свяжитесь с администратором.",
+                chat_name=chat_name
+            )
+        except Exception as send_error:
+            logger.error(f"{LOGGER_PREFIX} Не удалось отправить сообщение об ошибке: {send_error}")
+
+        notify_admins(
+            f"⚠️ Ошибка при обработке запроса кода от {chat_name}\n"
+            f"Номер: {phone_number}\n"
+            f"Item ID: {item_id}\n"
+            f"Ошибка: {str(ex)}",
+            found_order_id
+        )
+
+
+CD_COMMAND_PATTERN = re.compile(r'^cd(\s+\d+)?$', re.IGNORECASE)
+
+
+class CodeRequestScheduler:
+    """
+    Пул обработки команд "cd" вне потока событий FunPay. У каждого покупателя не больше одной
+    команды в работе и ограниченная очередь, покупатели обслуживаются по кругу.
+    """
+
+    def __init__(self, workers=CODE_REQUEST_WORKERS, max_per_buyer=CODE_REQUEST_MAX_PER_BUYER):
+        self.workers = workers
+        self.max_per_buyer = max_per_buyer
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._ready = collections.deque()
+        self._active = set()
+        self._stopped = False
+
+    def start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, c: Cardinal, e: NewMessageEvent):
+        """Ставит команду в очередь покупателя. False, если очередь покупателя заполнена"""
+        buyer = e.message.chat_name
+        with self._cond:
+            pending = self._pending.setdefault(buyer, collections.deque())
+            if len(pending) >= self.max_per_buyer:
+                return False
+            pending.append((c, e, time.monotonic()))
+            if buyer not in self._active and buyer not in self._ready:
+                self._ready.append(buyer)
+                self._cond.notify()
+        return True
+
+    def _take(self):
+        with self._cond:
+            while not self._stopped and not self._ready:
+                self._cond.wait()
+            if self._stopped:
                 return None
+            buyer = self._ready.popleft()
+            c, e, queued_at = self._pending[buyer].popleft()
+            self._active.add(buyer)
+        return buyer, c, e, queued_at
+
+    def _release(self, buyer):
+        with self._cond:
+            self._active.discard(buyer)
+            if self._pending.get(buyer):
+                # Следующая команда этого покупателя встаёт в конец круга
+                self._ready.append(buyer)
+                self._cond.notify()
+            else:
+                self._pending.pop(buyer, None)
 
-    return None
+    def run(self):
+        """Цикл обработчика, запускается в нескольких потоках"""
+        while True:
+            task = self._take()
+            if task is None:
+                return
+            buyer, c, e, queued_at = task
+            metrics.record("code.queue_wait", time.monotonic() - queued_at)
+            try:
+                with metrics.span("code.handle"):
+                    _handle_code_request(c, e)
+            finally:
+                self._release(buyer)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
 
 
 def handle_plus_message(c: Cardinal, e: NewMessageEvent):
-    """Обработчик сообщений для получения кодов"""
+    """Обработчик сообщений для получения кодов: быстрый разбор и передача команды в пул"""
+    buyer_outbox.remember_chat(e.message.chat_name, e.message.chat_id)
+
+    if not CD_COMMAND_PATTERN.match((e.message.text or "").strip()):
+        return
+
+    if not code_request_scheduler.submit(c, e):
+        logger.info(f"{LOGGER_PREFIX} Пропущена команда от {e.message.chat_name}: очередь покупателя заполнена")
+
+
+def _handle_code_request(c: Cardinal, e: NewMessageEvent):
+    """Разбор команды cd и постановка запроса кода, выполняется в пуле CodeRequestScheduler"""
     try:
         if not e.message.text or (
                 not e.message.text.strip().lower().startswith("cd") and e.message.text.strip() != "+"):
@@ -1633,15 +4132,12 @@ def handle_plus_message(c: Cardinal, e: NewMessageEvent):
 
         if e.message.text.strip().lower() == "cd":
             user_id = str(e.message.chat_name)
-            user_orders_data = load_user_orders()
             user_phones = set()
-            if user_id in user_orders_data["user_orders"]:
-                for order_data in user_orders_data["user_orders"][user_id].values():
-                    if "phone" in order_data:
-                        user_phones.add(order_data["phone"])
+            for order_data in order_store.get_user_orders(user_id).values():
+                if order_data["phone"]:
+                    user_phones.add(order_data["phone"])
 
-            next_order, orders = c.account.get_sells()
-            user_orders = [order for order in orders if order.buyer_username == e.message.chat_name]
+            user_orders = sells_index.get_buyer_orders(c, e.message.chat_name)
 
             for order in user_orders:
                 if order.id in order_phone_numbers:
@@ -1667,10 +4163,9 @@ def handle_plus_message(c: Cardinal, e: NewMessageEvent):
         logger.info(
             f"{LOGGER_PREFIX} Получен запрос на код для номера {phone_number} от пользователя {e.message.author}, чат {e.message.chat_id}")
 
-        user_orders_data = load_user_orders()
-
         user_id = str(e.message.chat_name)
-        if phone_number in user_orders_data["phone_users"] and user_orders_data["phone_users"][phone_number] != user_id:
+        phone_owner = order_store.get_phone_owner(phone_number)
+        if phone_owner and phone_owner != user_id:
             logger.warning(f"{LOGGER_PREFIX} Попытка доступа к чужому номеру {phone_number} пользователем {user_id}")
             c.account.send_message(
                 e.message.chat_id,
@@ -1682,16 +4177,12 @@ def handle_plus_message(c: Cardinal, e: NewMessageEvent):
         found_order_id = None
         item_id = None
 
-        if user_id in user_orders_data["user_orders"]:
-            for order_id, order_data in user_orders_data["user_orders"][user_id].items():
-                if order_data.get("phone") == phone_number:
-                    found_order_id = order_id
-                    item_id = order_data.get("item_id")
-                    break
+        stored_order = order_store.find_user_order_by_phone(user_id, phone_number)
+        if stored_order:
+            found_order_id, item_id = stored_order
 
         if not found_order_id:
-            next_order, orders = c.account.get_sells()
-            user_orders = [order for order in orders if order.buyer_username == e.message.chat_name]
+            user_orders = sells_index.get_buyer_orders(c, e.message.chat_name)
 
             if not user_orders:
                 c.account.send_message(
@@ -1725,54 +4216,26 @@ def handle_plus_message(c: Cardinal, e: NewMessageEvent):
             notify_admins(f"⚠️ Запрос кода для номера {phone_number}, но не настроен токен LOLZ", found_order_id)
             return
 
-        c.account.send_message(
-            e.message.chat_id,
-            "🔄 Запрос кода отправлен. Пожалуйста, подождите...",
-            chat_name=e.message.chat_name
-        )
-
-        codes_data = get_telegram_codes(item_id)
+        chat_id, chat_name = e.message.chat_id, e.message.chat_name
+        pending_state = code_poller.lookup(item_id, key=chat_id)
+        if pending_state == CodePoller.DUPLICATE:
+            logger.info(f"{LOGGER_PREFIX} Код для номера {phone_number} уже запрашивается для чата {chat_id}")
+            return
 
-        if not codes_data or 'codes' not in codes_data or not codes_data['codes']:
+        if pending_state in (None, CodePoller.JOINED):
             c.account.send_message(
-                e.message.chat_id,
-                f"❌ Не удалось получить код для номера {phone_number}. Код может появиться через несколько минут, попробуйте позже.",
-                chat_name=e.message.chat_name
+                chat_id,
+                "🔄 Запрос кода отправлен. Пожалуйста, подождите...",
+                chat_name=chat_name
             )
-            notify_admins(f"⚠️ Не удалось получить код для номера {phone_number}, item_id: {item_id}", found_order_id)
-            return
-
-        latest_code = codes_data['codes'][0]['code']
 
-        code_template = config.get("code_template", DEFAULT_CODE_TEMPLATE)
-
-        order_link = f"https://funpay.com/orders/{found_order_id}/"
-        message_text = code_template.format(
-            code=latest_code,
-            order_link=order_link,
-            order_id=found_order_id
+        code_poller.request(
+            item_id,
+            lambda codes_data: deliver_login_code(
+                c, chat_id, chat_name, user_id, phone_number, item_id, found_order_id, codes_data),
+            key=chat_id
         )
 
-        c.account.send_message(
-            e.message.chat_id,
-            message_text,
-            chat_name=e.message.chat_name
-        )
-
-        if user_id not in user_orders_data["user_orders"]:
-            user_orders_data["user_orders"][user_id] = {}
-
-        if found_order_id not in user_orders_data["user_orders"][user_id]:
-            user_orders_data["user_orders"][user_id][found_order_id] = {
-                "phone": phone_number,
-                "item_id": item_id
-            }
-
-        user_orders_data["phone_users"][phone_number] = user_id
-        save_user_orders(user_orders_data)
-
-        logger.info(f"{LOGGER_PREFIX} Успешно отправлен код для номера {phone_number} пользователю {user_id}")
-
     except Exception as ex:
         logger.error(f"{LOGGER_PREFIX} Ошибка при обработке запроса кода: {ex}")
         try:
@@ -1792,91 +4255,486 @@ def handle_plus_message(c: Cardinal, e: NewMessageEvent):
         notify_admins(error_details, found_order_id if 'found_order_id' in locals() else None)
 
 
-def process_order_queue():
-    """Функция для обработки очереди заказов в отдельном потоке"""
-    global active_tasks
+def resolve_order_lane(e: NewOrderEvent):
+    """Полоса очереди для заказа: код страны из метки 'tg:' в кратком описании, иначе общая полоса"""
+    tg_id = parse_tg_id(getattr(e.order, 'description', None))
+    if tg_id and country_index:
+        return country_index.lookup(tg_id) or ""
+    return ""
+
 
-    logger.info(f"{LOGGER_PREFIX} Запущен обработчик очереди заказов")
+def get_order_value(e: NewOrderEvent):
+    """Цена заказа для приоритета по сумме"""
+    try:
+        return float(getattr(e.order, 'price', 0) or 0)
+    except (TypeError, ValueError):
+        return 0.0
 
-    while True:
+
+class OrderLaneQueue:
+    """
+    Очередь заказов с полосами по странам. Между полосами - взвешенное чередование (stride scheduling):
+    каждая выдача сдвигает проход полосы на 1/вес, следующей берётся полоса с наименьшим проходом.
+    Режим "value" выбирает заказ с наибольшей суммой, "age" - полосу, дольше всех ждущую с учётом веса.
+    Заказ, ждущий дольше starvation_age, берётся первым в любом режиме.
+    """
+
+    def __init__(self, starvation_age=QUEUE_STARVATION_AGE, lane_share=QUEUE_LANE_MAX_SHARE):
+        self.starvation_age = starvation_age
+        self.lane_share = lane_share
+        self.limit = 1
+        self._cond = threading.Condition()
+        self._lanes = {}
+        self._pass = {}
+        self._virtual_time = 0.0
+        self._in_flight = collections.Counter()
+        self._size = 0
+        self._closed = False
+
+    @staticmethod
+    def _weight(lane):
+        country = config.get("countries", {}).get(lane) if lane else None
         try:
-            with task_lock:
-                can_process = active_tasks < max_concurrent_tasks
+            return max(1, int(country.get("weight", 1))) if country else 1
+        except (TypeError, ValueError):
+            return 1
+
+    @staticmethod
+    def _mode():
+        mode = config.get("queue_priority", "fair")
+        return mode if mode in QUEUE_PRIORITY_MODES else "fair"
+
+    def put(self, lane, order_data):
+        with self._cond:
+            entries = self._lanes.setdefault(lane, [])
+            if not entries:
+                # Простаивавшая полоса не копит кредит: её проход догоняет текущее виртуальное время
+                self._pass[lane] = max(self._pass.get(lane, 0.0), self._virtual_time)
+            entries.append(order_data)
+            self._size += 1
+            self._cond.notify()
+
+    def close(self):
+        """
+        Останавливает выдачу: get() сразу возвращает None. Заказы, оставшиеся в полосах, не запускаются
+        при остановке - их записи в журнале не закрыты, и они обрабатываются после перезапуска.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def get(self):
+        """Блокирующе выдаёт (полоса, заказ) по правилам планирования; None после close()"""
+        with self._cond:
+            while not self._closed and self._size == 0:
+                self._cond.wait()
+            if self._closed:
+                if self._size:
+                    logger.info(f"{LOGGER_PREFIX} Оставлено для обработки после перезапуска заказов: {self._size}")
+                return None
 
-            if can_process and not order_queue.empty():
-                order_data = order_queue.get()
-                cardinal = order_data['cardinal']
-                event = order_data['event']
+            now = time.monotonic()
+            mode = self._mode()
+            lane, index = self._pick(now, mode)
+            order_data = self._lanes[lane].pop(index)
+            self._size -= 1
+
+            self._virtual_time = max(self._virtual_time, self._pass[lane])
+            self._pass[lane] += 1.0 / self._weight(lane)
+            self._in_flight[lane] += 1
+            return lane, order_data
+
+    def _pick(self, now, mode):
+        waiting = [lane for lane, entries in self._lanes.items() if entries]
+
+        # Заказы в полосе лежат в порядке поступления, поэтому первый - самый старый
+        oldest_lane = min(waiting, key=lambda lane: self._lanes[lane][0]['enqueued_at'])
+        if now - self._lanes[oldest_lane][0]['enqueued_at'] >= self.starvation_age:
+            return oldest_lane, 0
+
+        cap = max(1, int(self.limit * self.lane_share))
+        candidates = [lane for lane in waiting if self._in_flight[lane] < cap] or waiting
+
+        if mode == "value":
+            best = None
+            for lane in candidates:
+                for index, entry in enumerate(self._lanes[lane]):
+                    key = (entry['value'], -self._pass[lane], -entry['enqueued_at'])
+                    if best is None or key > best[0]:
+                        best = (key, lane, index)
+            return best[1], best[2]
+
+        if mode == "age":
+            lane = max(candidates,
+                       key=lambda lane: (now - self._lanes[lane][0]['enqueued_at']) * self._weight(lane))
+            return lane, 0
+
+        return min(candidates, key=lambda lane: self._pass[lane]), 0
+
+    def done(self, lane):
+        """Заказ полосы завершён и больше не занимает её долю лимита"""
+        with self._cond:
+            self._in_flight[lane] -= 1
+            if self._in_flight[lane] <= 0:
+                del self._in_flight[lane]
+            if not self._lanes.get(lane) and lane not in self._in_flight:
+                # Пустые полосы удалённых стран не копятся
+                self._lanes.pop(lane, None)
+                self._pass.pop(lane, None)
+
+    def qsize(self):
+        with self._cond:
+            return self._size
+
+    def lane_sizes(self):
+        with self._cond:
+            return {lane: len(entries) for lane, entries in self._lanes.items() if entries}
+
+
+class OrderDispatcher:
+    """
+    Диспетчер очереди заказов: блокирующее ожидание заказа и ограничение числа задач в работе.
+    Заказы раскладываются по полосам стран (OrderLaneQueue), чтобы страна без наличия на LZT
+    не задерживала заказы остальных. Лимит меняется по схеме AIMD: растёт на единицу, пока есть очередь и LZT отвечает штатно,
+    и уменьшается вдвое при 429/retry_request, ошибках сервера или резком росте задержек поиска и покупки
+    в потоках заказов; опрос кодов, импорт и предзагрузка на лимит не влияют.
+    """
 
-                with task_lock:
-                    active_tasks += 1
+    def __init__(self, executor, initial_limit, min_limit=DEFAULT_CONCURRENCY_MIN, max_limit=DEFAULT_CONCURRENCY_MAX):
+        self._queue = OrderLaneQueue()
+        self._executor = executor
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._limit = max(min_limit, min(max_limit, initial_limit))
+        self._last_change = time.monotonic()
+        self._last_congestion = 0.0
+        self._latency = {}
+        self._held = {}
+        self._held_lock = threading.Lock()
+        self._in_flight = 0
+        self._slots = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self._dispatched = 0
+        self._total_wait = 0.0
+        self._last_wait = 0.0
+        self._max_wait = 0.0
+
+    def submit(self, c: Cardinal, e: NewOrderEvent):
+        self._queue.put(resolve_order_lane(e), {
+            'cardinal': c,
+            'event': e,
+            'value': get_order_value(e),
+            'enqueued_at': time.monotonic()
+        })
+
+    def stop(self):
+        self._queue.close()
+
+    def run(self):
+        """Цикл диспетчера, запускается в отдельном потоке"""
+        logger.info(f"{LOGGER_PREFIX} Запущен обработчик очереди заказов")
+
+        while True:
+            # Сначала ждём свободный слот и только потом выбираем заказ, чтобы приоритет
+            # учитывал все заказы, пришедшие за время ожидания
+            with self._slots:
+                while self._in_flight >= self._limit:
+                    self._slots.wait()
+                self._queue.limit = self._limit
+
+            task = self._queue.get()
+            if task is None:
+                logger.info(f"{LOGGER_PREFIX} Обработчик очереди заказов остановлен")
+                return
+            lane, order_data = task
 
-                future = executor.submit(process_order, cardinal, event)
-                future.add_done_callback(lambda f: handle_processing_complete(f))
+            with self._slots:
+                self._in_flight += 1
+                in_flight = self._in_flight
+
+            try:
+                event = order_data['event']
+                self._record_wait(time.monotonic() - order_data['enqueued_at'])
+
+                future = self._executor.submit(process_order, order_data['cardinal'], event)
+                future.add_done_callback(
+                    lambda f, order_id=event.order.id, lane=lane: self._on_complete(f, order_id, lane))
 
                 logger.info(
-                    f"{LOGGER_PREFIX} Начата обработка заказа #{event.order.id} в отдельном потоке. Активных задач: {active_tasks}")
+                    f"{LOGGER_PREFIX} Начата обработка заказа #{event.order.id} (полоса {lane or '-'}) "
+                    f"в отдельном потоке. Активных задач: {in_flight}")
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике очереди заказов: {e}")
+                self._queue.done(lane)
+                self._release_slot()
+
+    def _record_wait(self, wait):
+        metrics.record("order.queue_wait", wait)
+        with self._stats_lock:
+            self._dispatched += 1
+            self._total_wait += wait
+            self._last_wait = wait
+            self._max_wait = max(self._max_wait, wait)
+
+    def _release_slot(self):
+        with self._slots:
+            self._in_flight -= 1
+            self._slots.notify()
+            return self._in_flight
+
+    def hold(self, c: Cardinal, e: NewOrderEvent):
+        """
+        Откладывает заказ до восстановления LZT Market. Запись в журнале остаётся незавершённой,
+        поэтому отложенный заказ переживает и перезапуск. True, если заказ отложен впервые.
+        """
+        with self._held_lock:
+            first_time = e.order.id not in self._held
+            self._held[e.order.id] = (c, e)
+        return first_time
+
+    def release_held(self):
+        """Возвращает отложенные заказы в очередь"""
+        with self._held_lock:
+            held = list(self._held.values())
+            self._held.clear()
+        if held:
+            logger.info(f"{LOGGER_PREFIX} Возврат в очередь {len(held)} отложенных заказов")
+        for c, e in held:
+            self.submit(c, e)
+
+    def held_count(self):
+        with self._held_lock:
+            return len(self._held)
+
+    def _is_held(self, order_id):
+        with self._held_lock:
+            return order_id in self._held
+
+    def set_bounds(self, min_limit, max_limit):
+        """Новые границы из настроек, текущий лимит приводится в них"""
+        with self._slots:
+            self._min_limit = min_limit
+            self._max_limit = max_limit
+            self._limit = max(min_limit, min(max_limit, self._limit))
+            self._last_change = time.monotonic()
+            self._slots.notify_all()
+        logger.info(f"{LOGGER_PREFIX} Границы параллельности: {min_limit}-{max_limit}, текущий лимит: {self._limit}")
+
+    def on_lzt_response(self, endpoint, elapsed, congested=False):
+        """Сигнал от клиента LZT: перегрузка или задержка выше базовой уменьшают лимит"""
+        with self._slots:
+            stats = self._latency.get(endpoint)
+            if stats is None:
+                stats = self._latency[endpoint] = {"ewma": elapsed, "floor": elapsed, "samples": 0}
+            stats["ewma"] = stats["ewma"] * 0.8 + elapsed * 0.2
+            # Базовая задержка медленно подтягивается вверх, чтобы забывать давние минимумы
+            stats["floor"] = min(stats["ewma"], stats["floor"] * 1.005)
+            stats["samples"] += 1
+
+            slow = stats["samples"] >= 10 and stats["ewma"] > stats["floor"] * CONCURRENCY_LATENCY_FACTOR
+            if congested or slow:
+                self._decrease(endpoint, "перегрузка" if congested else "рост задержек")
+
+    def _decrease(self, endpoint, reason):
+        now = time.monotonic()
+        self._last_congestion = now
+        if now - self._last_change < CONCURRENCY_DECREASE_COOLDOWN or self._limit <= self._min_limit:
+            return
+        previous = self._limit
+        self._limit = max(self._min_limit, self._limit // 2)
+        self._last_change = now
+        logger.warning(
+            f"{LOGGER_PREFIX} Параллельность снижена с {previous} до {self._limit}: {reason} LZT ({endpoint})")
+
+    def _maybe_increase(self):
+        """Аддитивное увеличение лимита, пока есть очередь и LZT отвечает штатно"""
+        now = time.monotonic()
+        with self._slots:
+            if (self._limit >= self._max_limit or self._queue.qsize() == 0
+                    or now - self._last_change < CONCURRENCY_INCREASE_INTERVAL
+                    or now - self._last_congestion < CONCURRENCY_DECREASE_COOLDOWN):
+                return
+            self._limit += 1
+            self._last_change = now
+            self._slots.notify()
+            limit = self._limit
+        logger.info(f"{LOGGER_PREFIX} Параллельность увеличена до {limit}")
+
+    def _on_complete(self, future, order_id, lane=""):
+        """Обработчик завершения выполнения задачи в пуле потоков"""
+        try:
+            result = future.result()
+            logger.info(f"{LOGGER_PREFIX} Обработка заказа завершена: {result}")
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Ошибка при обработке заказа: {e}")
+        finally:
+            held = self._is_held(order_id)
+            if order_journal and not held:
+                order_journal.complete(order_id)
+            self._queue.done(lane)
+            current_tasks = self._release_slot()
+            self._maybe_increase()
+            if held and lzt_breaker and lzt_breaker.state == CircuitBreaker.CLOSED:
+                # API восстановился, пока заказ откладывался
+                self.release_held()
+            logger.info(f"{LOGGER_PREFIX} Завершена обработка заказа. Осталось активных задач: {current_tasks}")
+
+    def get_stats(self):
+        """Текущая глубина очереди, число задач в работе и время ожидания"""
+        with self._stats_lock:
+            avg_wait = self._total_wait / self._dispatched if self._dispatched else 0.0
+            stats = {
+                "queue_depth": self._queue.qsize(),
+                "lanes": self._queue.lane_sizes(),
+                "dispatched": self._dispatched,
+                "last_wait": self._last_wait,
+                "avg_wait": avg_wait,
+                "max_wait": self._max_wait
+            }
+        with self._slots:
+            stats["in_flight"] = self._in_flight
+            stats["limit"] = self._limit
+            stats["min_limit"] = self._min_limit
+            stats["max_limit"] = self._max_limit
+        stats["held"] = self.held_count()
+        return stats
+
+
+TG_TAG_PATTERN = re.compile(r'tg:\s*(\w+)', re.IGNORECASE)
+
+
+def parse_tg_id(text):
+    """Извлекает ID из метки 'tg:' в описании заказа"""
+    if not text or 'tg:' not in text.lower():
+        return None
+    tg_match = TG_TAG_PATTERN.search(text)
+    return tg_match.group(1).upper() if tg_match else None
 
-            time.sleep(0.5)
+
+class LazyFullOrder:
+    """Полный заказ FunPay, который запрашивается через get_order только при первом обращении"""
+
+    def __init__(self, c: Cardinal, order_id):
+        self._c = c
+        self._order_id = order_id
+        self._order = None
+
+    def get(self):
+        if self._order is None:
+            with metrics.span("order.get_order"):
+                self._order = self._c.account.get_order(self._order_id)
+        return self._order
+
+    def get_sum(self, default):
+        """Сумма заказа для учёта прибыли, при ошибке загрузки - цена из события"""
+        try:
+            order = self.get()
+            return order.sum if hasattr(order, 'sum') else default
         except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Ошибка в обработчике очереди заказов: {e}")
-            time.sleep(1)
+            logger.error(f"{LOGGER_PREFIX} Не удалось получить сумму заказа #{self._order_id}: {e}")
+            return default
+
+
+def refund_order(c: Cardinal, order_id):
+    """
+    Возврат средств по заказу. Отметка ставится до запроса: лучше не повторить заказ с неудавшимся
+    возвратом (администратор получает уведомление об ошибке), чем купить аккаунт по возвращённому заказу.
+    """
+    order_store.set_order_state(order_id, ORDER_STATE_REFUNDED)
+    c.account.refund(order_id)
 
 
-def handle_processing_complete(future):
-    """Обработчик завершения выполнения задачи в пуле потоков"""
-    global active_tasks
+def resume_interrupted_order(c: Cardinal, e: NewOrderEvent, state):
+    """Заказ из журнала, обработка которого прервалась после начала покупки или возврата"""
+    order_id = e.order.id
 
-    try:
-        result = future.result()
+    if state["state"] == ORDER_STATE_REFUNDED:
+        logger.info(f"{LOGGER_PREFIX} По заказу #{order_id} уже выполнялся возврат. Пропуск.")
+        return f"Заказ #{order_id} уже возвращён"
+
+    if state["state"] == ORDER_STATE_PURCHASED and state["phone"]:
+        # Аккаунт куплен, но номер не успели сохранить и выдать
+        phone = state["phone"]
+        order_store.add_order(str(e.order.buyer_username), order_id, phone, state["item_id"], replace=False)
+        # Запись о заказе сохранена: дальнейший повтор из журнала выдаст номер по ней
+        order_store.clear_order_state(order_id)
+        order_phone_numbers[order_id] = phone
+        order_account_ids[order_id] = state["item_id"]
+        purchase_template = config.get("purchase_template", DEFAULT_PURCHASE_TEMPLATE)
+        deliver_order_message(c, e, purchase_template.format(phone=phone))
+        if state.get("cost") is not None:
+            save_order_profit(order_id, LazyFullOrder(c, order_id).get_sum(e.order.price), state["cost"])
+            order_index.upsert(order_id)
+        notify_admins(
+            f"♻️ Заказ #{order_id}: аккаунт ID {state['item_id']} был куплен до перезапуска, номер {phone} выдан покупателю",
+            order_id)
+        return f"Заказ #{order_id} выдан после перезапуска"
+
+    logger.warning(f"{LOGGER_PREFIX} Обработка заказа #{order_id} прервалась во время покупки аккаунта ID {state['item_id']}")
+    notify_admins(
+        f"⚠️ Обработка заказа #{order_id} прервалась во время покупки аккаунта ID {state['item_id']}. "
+        f"Повторная покупка не выполнялась, проверьте историю покупок LZT Market и заказ вручную.",
+        order_id)
+    return f"Заказ #{order_id} требует ручной проверки"
 
-        logger.info(f"{LOGGER_PREFIX} Обработка заказа завершена: {result}")
-    except Exception as e:
-        logger.error(f"{LOGGER_PREFIX} Ошибка при обработке заказа: {e}")
-    finally:
-        with task_lock:
-            active_tasks -= 1
-            current_tasks = active_tasks
 
-        logger.info(f"{LOGGER_PREFIX} Завершена обработка заказа. Осталось активных задач: {current_tasks}")
+# Отмечает поток пула, занятый заказом: по этому признаку LztClient отличает запросы заказов от фоновых
+order_worker_context = threading.local()
 
 
 def process_order(c: Cardinal, e: NewOrderEvent):
     """
     Функция обработки заказа, запускаемая в отдельном потоке.
     """
+    order_worker_context.active = True
+    try:
+        with metrics.span("order.total"):
+            return _process_order(c, e)
+    finally:
+        order_worker_context.active = False
+
+
+def _process_order(c: Cardinal, e: NewOrderEvent):
+    """Этапы обработки заказа, общее время замеряет process_order"""
     order_id = e.order.id
     logger.info(f"{LOGGER_PREFIX} Начата фактическая обработка заказа #{order_id}")
 
     logger.info(f"{LOGGER_PREFIX} Обработка заказа: {order_id}")
 
+    # Отметка читается раньше записи о заказе: запись могла появиться без выдачи номера покупателю
+    state = order_store.get_order_state(order_id)
+    if state:
+        return resume_interrupted_order(c, e, state)
+
+    stored = order_store.get_order(order_id)
+    if stored:
+        if isinstance(e, JournaledOrderEvent) and stored["phone"]:
+            # Запись в журнале закрывается после доставки номера, значит до перезапуска он не дошёл
+            logger.info(f"{LOGGER_PREFIX} Номер по заказу #{order_id} не был доставлен до перезапуска, отправляем снова")
+            purchase_template = config.get("purchase_template", DEFAULT_PURCHASE_TEMPLATE)
+            deliver_order_message(c, e, purchase_template.format(phone=stored["phone"]))
+            return f"Номер по заказу #{order_id} отправлен повторно"
+        logger.info(f"{LOGGER_PREFIX} Заказ #{order_id} уже выполнен ранее. Пропуск.")
+        return f"Заказ #{order_id} уже выполнен"
+
     try:
-        full_order = c.account.get_order(order_id)
+        full_order = LazyFullOrder(c, order_id)
 
         description = e.order.description or ""
-        full_desc = full_order.full_description or ""
-
-        logger.info(f"{LOGGER_PREFIX} Краткое описание заказа #{full_order.id}: {description}")
-        logger.info(f"{LOGGER_PREFIX} Полное описание заказа #{full_order.id}: {full_desc}")
-
-        has_tg_prefix = False
-        tg_match = None
+        logger.info(f"{LOGGER_PREFIX} Краткое описание заказа #{order_id}: {description}")
 
-        if 'tg:' in full_desc.lower():
-            tg_match = re.search(r'tg:\s*(\w+)', full_desc, re.IGNORECASE)
-            if tg_match:
-                has_tg_prefix = True
+        # Метка обычно есть уже в кратком описании события, тогда get_order не нужен до выдачи номера
+        tg_id = parse_tg_id(description)
 
-        if not has_tg_prefix and 'tg:' in description.lower():
-            tg_match = re.search(r'tg:\s*(\w+)', description, re.IGNORECASE)
-            if tg_match:
-                has_tg_prefix = True
+        if not tg_id:
+            full_desc = full_order.get().full_description or ""
+            logger.info(f"{LOGGER_PREFIX} Полное описание заказа #{order_id}: {full_desc}")
+            tg_id = parse_tg_id(full_desc)
 
-        if not has_tg_prefix or not tg_match:
-            logger.info(f"{LOGGER_PREFIX} В заказе #{full_order.id} нет метки 'tg:' с ID. Пропуск.")
+        if not tg_id:
+            logger.info(f"{LOGGER_PREFIX} В заказе #{order_id} нет метки 'tg:' с ID. Пропуск.")
             return f"Нет метки 'tg:' в заказе #{order_id}"
 
-        tg_id = tg_match.group(1).upper()
         logger.info(f"{LOGGER_PREFIX} Найден ID телеграм: {tg_id}")
 
         try:
@@ -1886,17 +4744,18 @@ def process_order(c: Cardinal, e: NewOrderEvent):
                 amount = e.order.amount
             else:
                 amount = 1
-                if hasattr(full_order, 'amount') and full_order.amount is not None:
-                    amount = full_order.amount
+                loaded_order = full_order.get()
+                if hasattr(loaded_order, 'amount') and loaded_order.amount is not None:
+                    amount = loaded_order.amount
 
-            logger.info(f"{LOGGER_PREFIX} Количество товара в заказе #{full_order.id}: {amount}")
+            logger.info(f"{LOGGER_PREFIX} Количество товара в заказе #{order_id}: {amount}")
 
             if amount > 1:
                 logger.warning(
-                    f"{LOGGER_PREFIX} Заказ #{full_order.id} содержит больше 1 товара ({amount}). Выполняем возврат.")
+                    f"{LOGGER_PREFIX} Заказ #{order_id} содержит больше 1 товара ({amount}). Выполняем возврат.")
 
                 try:
-                    c.account.refund(full_order.id)
+                    refund_order(c, order_id)
                     message_text = (
                         "Извините, но заказ телеграм аккаунта можно оформлять только в количестве 1 штуки.\n\n"
                         "Ваши средства были автоматически возвращены. Пожалуйста, создайте новый заказ, "
@@ -1904,37 +4763,39 @@ def process_order(c: Cardinal, e: NewOrderEvent):
                     )
                     send_message_to_buyer(c, e.order.buyer_username, message_text)
 
-                    admin_message = f"⚠️ Автоматический возврат для заказа #{full_order.id} из-за неверного количества товара ({amount})"
-                    notify_admins(admin_message, full_order.id)
+                    admin_message = f"⚠️ Автоматический возврат для заказа #{order_id} из-за неверного количества товара ({amount})"
+                    notify_admins(admin_message, order_id)
                     logger.info(
-                        f"{LOGGER_PREFIX} Выполнен автоматический возврат для заказа #{full_order.id} из-за неверного количества")
+                        f"{LOGGER_PREFIX} Выполнен автоматический возврат для заказа #{order_id} из-за неверного количества")
                     return f"Автоматический возврат для заказа #{order_id} из-за неверного количества товара ({amount})"
                 except Exception as refund_error:
                     logger.error(
-                        f"{LOGGER_PREFIX} Ошибка при автоматическом возврате для заказа #{full_order.id}: {refund_error}")
+                        f"{LOGGER_PREFIX} Ошибка при автоматическом возврате для заказа #{order_id}: {refund_error}")
                     notify_admins(
-                        f"❌ Ошибка при автоматическом возврате для заказа #{full_order.id} (количество товара {amount}): {refund_error}",
-                        full_order.id)
+                        f"❌ Ошибка при автоматическом возврате для заказа #{order_id} (количество товара {amount}): {refund_error}",
+                        order_id)
         except Exception as amount_error:
             logger.error(
-                f"{LOGGER_PREFIX} Ошибка при определении количества товара в заказе #{full_order.id}: {amount_error}")
+                f"{LOGGER_PREFIX} Ошибка при определении количества товара в заказе #{order_id}: {amount_error}")
 
         country_info = ""
         country_code = ""
         min_price = 0
         max_price = 0
-        for code, country_data in config["countries"].items():
-            if tg_id.startswith(code):
-                country_code = code
-                min_price = country_data['min_price']
-                max_price = country_data['max_price']
-                break
+        matched_code = country_index.lookup(tg_id)
+        country_data = config["countries"].get(matched_code) if matched_code else None
+        if country_data:
+            country_code = matched_code
+            min_price = country_data['min_price']
+            max_price = country_data['max_price']
 
         purchase_template = config.get("purchase_template", DEFAULT_PURCHASE_TEMPLATE)
 
         message_text = "Спасибо за покупку!"
         purchase_result = None
         account_data = None
+        lolz_cost = None
+        success_notification = None
 
         if country_code and config["lolz_token"]:
             try:
@@ -1942,13 +4803,15 @@ def process_order(c: Cardinal, e: NewOrderEvent):
                 purchase_success = False
                 insufficient_funds = False
 
-                logger.info(f"{LOGGER_PREFIX} Поиск аккаунтов для страны {country_code}")
-                available_accounts = find_available_accounts(country_code, min_price, max_price)
+                with metrics.span("order.acquire") as span:
+                    purchase_result, account_data, funds_issue, available_accounts = acquire_account(
+                        country_code, min_price, max_price, order_id)
+                    if not purchase_result or 'item' not in purchase_result:
+                        span.fail()
+                        # Все попытки покупки получили однозначный отказ, отметка о покупке больше не нужна
+                        order_store.clear_order_state(order_id)
 
                 if available_accounts:
-                    logger.info(f"{LOGGER_PREFIX} Найдено {len(available_accounts)} аккаунтов")
-                    purchase_result, account_data, funds_issue = try_purchase_accounts(available_accounts)
-
                     if funds_issue:
                         insufficient_funds = True
                         purchase_failed = True
@@ -1957,43 +4820,32 @@ def process_order(c: Cardinal, e: NewOrderEvent):
 
                     if purchase_result and 'item' in purchase_result:
                         item_id = purchase_result['item'].get('item_id')
+                        item_cost = purchase_result['item'].get('price', 0)
                         logger.info(f"{LOGGER_PREFIX} Успешно куплен аккаунт ID: {item_id}")
 
-                        order_account_ids[full_order.id] = item_id
+                        order_store.set_order_state(
+                            order_id, ORDER_STATE_PURCHASED, item_id,
+                            account_data.get('telegram_phone') if account_data else None, item_cost)
+                        order_account_ids[order_id] = item_id
 
                         if account_data and 'telegram_phone' in account_data:
                             phone = account_data['telegram_phone']
                             message_text = purchase_template.format(phone=phone)
-                            order_phone_numbers[full_order.id] = phone
+                            order_phone_numbers[order_id] = phone
                             user_id = str(e.order.buyer_username)
-                            user_orders_data = load_user_orders()
-
-                            if user_id not in user_orders_data["user_orders"]:
-                                user_orders_data["user_orders"][user_id] = {}
-
-                            user_orders_data["user_orders"][user_id][str(full_order.id)] = {
-                                "phone": phone,
-                                "item_id": item_id
-                            }
-
-                            user_orders_data["phone_users"][phone] = user_id
-                            save_user_orders(user_orders_data)
-
-                            lolz_cost = purchase_result['item'].get('price', 0)
-                            fp_sum = full_order.sum if hasattr(full_order, 'sum') else e.order.price
-                            save_order_profit(full_order.id, fp_sum, lolz_cost)
-
-                            profit_data = get_order_profit(full_order.id)
+                            order_store.add_order(user_id, order_id, phone, item_id)
+                            # Запись о заказе сохранена: дальнейший повтор из журнала выдаст номер по ней
+                            order_store.clear_order_state(order_id)
+                            lolz_cost = item_cost
                         else:
                             message_text = purchase_template.format(phone="Не удалось получить")
 
                         if account_data:
-                            admin_notification = (
-                                f"✅ Успешно куплен и выдан аккаунт для заказа #{full_order.id}:\n"
+                            success_notification = (
+                                f"✅ Успешно куплен и выдан аккаунт для заказа #{order_id}:\n"
                                 f"Покупатель: {e.order.buyer_username}\n"
                                 f"Телефон: {account_data['telegram_phone']}\n"
                             )
-                            notify_admins(admin_notification, full_order.id)
 
                         purchase_success = True
                     else:
@@ -2008,82 +4860,113 @@ def process_order(c: Cardinal, e: NewOrderEvent):
                         logger.error(
                             f"{LOGGER_PREFIX} Недостаточно средств на балансе LOLZ Market для покупки аккаунтов")
                         try:
-                            c.account.refund(full_order.id)
+                            refund_order(c, order_id)
                             message_text = f"К сожалению, произошла ошибка при покупке аккаунта для страны {country_code}. Средства автоматически возвращены."
                             notify_admins(
-                                f"💰 Автоматический возврат выполнен для заказа #{full_order.id} из-за недостатка средств на балансе LOLZ Market",
-                                full_order.id)
+                                f"💰 Автоматический возврат выполнен для заказа #{order_id} из-за недостатка средств на балансе LOLZ Market",
+                                order_id)
                             logger.info(
-                                f"{LOGGER_PREFIX} Выполнен автоматический возврат для заказа #{full_order.id} из-за недостатка средств")
+                                f"{LOGGER_PREFIX} Выполнен автоматический возврат для заказа #{order_id} из-за недостатка средств")
                         except Exception as refund_error:
                             message_text = f"Спасибо за покупку! Вы приобрели телеграм аккаунт с ID: {tg_id}.{country_info}\n\nВаш заказ принят и будет обработан оператором в ближайшее время."
-                            admin_message = f"⚠️ СРОЧНО! Недостаточно средств на балансе LOLZ Market для обработки заказа #{full_order.id}. Пополните баланс! Ошибка при возврате: {refund_error}"
-                            notify_admins(admin_message, full_order.id)
+                            admin_message = f"⚠️ СРОЧНО! Недостаточно средств на балансе LOLZ Market для обработки заказа #{order_id}. Пополните баланс! Ошибка при возврате: {refund_error}"
+                            notify_admins(admin_message, order_id)
                             logger.error(
-                                f"{LOGGER_PREFIX} Ошибка при автоматическом возврате для заказа #{full_order.id} из-за недостатка средств: {refund_error}")
+                                f"{LOGGER_PREFIX} Ошибка при автоматическом возврате для заказа #{order_id} из-за недостатка средств: {refund_error}")
                     elif purchase_failed:
                         logger.error(f"{LOGGER_PREFIX} Не удалось купить ни один аккаунт")
                         message_text = f"Спасибо за покупку! Вы приобрели телеграм аккаунт с ID: {tg_id}.{country_info}\n\nК сожалению, произошла ошибка при автоматической покупке аккаунта. Наш администратор свяжется с вами в ближайшее время."
 
-                        admin_message = f"⚠️ Не удалось купить ни один аккаунт для заказа #{full_order.id}. Все доступные аккаунты ({len(available_accounts) if available_accounts else 0}) оказались проданы."
-                        notify_admins(admin_message, full_order.id)
+                        admin_message = f"⚠️ Не удалось купить ни один аккаунт для заказа #{order_id}. Все доступные аккаунты ({len(available_accounts) if available_accounts else 0}) оказались проданы."
+                        notify_admins(admin_message, order_id, low_priority=True)
 
                         if config["auto_returns"]:
                             try:
-                                c.account.refund(full_order.id)
+                                refund_order(c, order_id)
                                 message_text = f"К сожалению, произошла ошибка при покупке аккаунта для страны {country_code}. Средства автоматически возвращены."
-                                notify_admins(f"💰 Автоматический возврат выполнен для заказа #{full_order.id}",
-                                              full_order.id)
+                                notify_admins(f"💰 Автоматический возврат выполнен для заказа #{order_id}",
+                                              order_id)
                                 logger.info(
-                                    f"{LOGGER_PREFIX} Выполнен автоматический возврат для заказа #{full_order.id}")
+                                    f"{LOGGER_PREFIX} Выполнен автоматический возврат для заказа #{order_id}")
                             except Exception as refund_error:
                                 logger.error(
-                                    f"{LOGGER_PREFIX} Ошибка при автоматическом возврате для заказа #{full_order.id}: {refund_error}")
+                                    f"{LOGGER_PREFIX} Ошибка при автоматическом возврате для заказа #{order_id}: {refund_error}")
                                 notify_admins(
-                                    f"❌ Ошибка при автоматическом возврате для заказа #{full_order.id}: {refund_error}",
-                                    full_order.id)
+                                    f"❌ Ошибка при автоматическом возврате для заказа #{order_id}: {refund_error}",
+                                    order_id)
                     else:
                         logger.warning(f"{LOGGER_PREFIX} Не найдено подходящих аккаунтов для страны {country_code}")
                         message_text = f"Спасибо за покупку! Вы приобрели телеграм аккаунт с ID: {tg_id}.{country_info}\n\nВ настоящий момент нет доступных аккаунтов для этой страны. Наш администратор свяжется с вами в ближайшее время."
 
-                        admin_message = f"⚠️ Нет доступных аккаунтов для заказа #{full_order.id}, страна: {country_code}"
-                        notify_admins(admin_message, full_order.id)
+                        admin_message = f"⚠️ Нет доступных аккаунтов для заказа #{order_id}, страна: {country_code}"
+                        notify_admins(admin_message, order_id, low_priority=True)
 
                         if config["auto_returns"]:
                             try:
-                                c.account.refund(full_order.id)
+                                refund_order(c, order_id)
                                 message_text = f"К сожалению, в данный момент нет доступных аккаунтов для страны {country_code}. Средства автоматически возвращены."
-                                notify_admins(f"💰 Автоматический возврат выполнен для заказа #{full_order.id}",
-                                              full_order.id)
+                                notify_admins(f"💰 Автоматический возврат выполнен для заказа #{order_id}",
+                                              order_id)
                                 logger.info(
-                                    f"{LOGGER_PREFIX} Выполнен автоматический возврат для заказа #{full_order.id}")
+                                    f"{LOGGER_PREFIX} Выполнен автоматический возврат для заказа #{order_id}")
                             except Exception as refund_error:
                                 logger.error(
-                                    f"{LOGGER_PREFIX} Ошибка при автоматическом возврате для заказа #{full_order.id}: {refund_error}")
+                                    f"{LOGGER_PREFIX} Ошибка при автоматическом возврате для заказа #{order_id}: {refund_error}")
                                 notify_admins(
-                                    f"❌ Ошибка при автоматическом возврате для заказа #{full_order.id}: {refund_error}",
-                                    full_order.id)
+                                    f"❌ Ошибка при автоматическом возврате для заказа #{order_id}: {refund_error}",
+                                    order_id)
             except Exception as ex:
+                if isinstance(ex, LztUnavailableError) and config.get("hold_on_lzt_outage") and order_dispatcher:
+                    logger.warning(f"{LOGGER_PREFIX} LZT Market недоступен, заказ #{order_id} отложен")
+                    # Запрос отклонён до отправки, аккаунт не куплен: после восстановления заказ обрабатывается заново
+                    order_store.clear_order_state(order_id)
+                    if order_dispatcher.hold(c, e):
+                        send_message_to_buyer(
+                            c, e.order.buyer_username,
+                            "⏳ Спасибо за покупку! Сервис выдачи аккаунтов временно недоступен. "
+                            "Аккаунт будет выдан автоматически, как только работа восстановится."
+                        )
+                        notify_admins(f"⏸ Заказ #{order_id} отложен до восстановления LZT Market", order_id,
+                                      low_priority=True)
+                    return f"Заказ #{order_id} отложен до восстановления LZT Market"
+
                 logger.error(f"{LOGGER_PREFIX} Ошибка при запросе к API LOLZ Market: {ex}")
                 message_text = f"Спасибо за покупку! Вы приобрели телеграм аккаунт с ID: {tg_id}.{country_info}"
 
-                admin_message = f"⚠️ Ошибка при обработке заказа #{full_order.id}: {ex}"
-                notify_admins(admin_message, full_order.id)
+                if isinstance(ex, LztPurchaseUnknownError):
+                    # Повторять покупку нельзя: аккаунт мог быть уже куплен
+                    admin_message = (f"⚠️ Заказ #{order_id}: {ex}. Проверьте историю покупок LZT Market, "
+                                     f"повторная покупка не выполнялась.")
+                else:
+                    admin_message = f"⚠️ Ошибка при обработке заказа #{order_id}: {ex}"
+                notify_admins(admin_message, order_id)
 
                 if config["auto_returns"]:
                     try:
-                        c.account.refund(full_order.id)
+                        refund_order(c, order_id)
                         message_text = f"К сожалению, произошла техническая ошибка при обработке заказа. Средства автоматически возвращены."
-                        notify_admins(f"💰 Автоматический возврат выполнен для заказа #{full_order.id}", full_order.id)
-                        logger.info(f"{LOGGER_PREFIX} Выполнен автоматический возврат для заказа #{full_order.id}")
+                        notify_admins(f"💰 Автоматический возврат выполнен для заказа #{order_id}", order_id)
+                        logger.info(f"{LOGGER_PREFIX} Выполнен автоматический возврат для заказа #{order_id}")
                     except Exception as refund_error:
                         logger.error(
-                            f"{LOGGER_PREFIX} Ошибка при автоматическом возврате для заказа #{full_order.id}: {refund_error}")
+                            f"{LOGGER_PREFIX} Ошибка при автоматическом возврате для заказа #{order_id}: {refund_error}")
                         notify_admins(
-                            f"❌ Ошибка при автоматическом возврате для заказа #{full_order.id}: {refund_error}",
-                            full_order.id)
+                            f"❌ Ошибка при автоматическом возврате для заказа #{order_id}: {refund_error}",
+                            order_id)
+
+        with metrics.span("order.deliver"):
+            deliver_order_message(c, e, message_text)
+
+        if lolz_cost is not None:
+            # Сумма заказа нужна только для учёта прибыли, поэтому полный заказ загружается после выдачи номера
+            with metrics.span("order.save_profit"):
+                save_order_profit(order_id, full_order.get_sum(e.order.price), lolz_cost)
+                order_index.upsert(order_id)
+
+        if success_notification:
+            with metrics.span("order.notify_admins"):
+                notify_admins(success_notification, order_id)
 
-        send_message_to_buyer(c, e.order.buyer_username, message_text)
         return f"Заказ #{order_id} успешно обработан"
 
     except Exception as ex:
@@ -2094,11 +4977,60 @@ def process_order(c: Cardinal, e: NewOrderEvent):
 def shutdown():
     """Функция для корректного завершения работы плагина"""
     global executor
+    if order_dispatcher:
+        order_dispatcher.stop()
+
+    if lzt_breaker:
+        lzt_breaker.stop()
+
+    if sells_importer:
+        sells_importer.stop()
+
+    if inventory_cache:
+        inventory_cache.stop()
+
+    if code_request_scheduler:
+        code_request_scheduler.stop()
+
+    if code_poller:
+        code_poller.stop()
+
     if executor:
         logger.info(f"{LOGGER_PREFIX} Завершение работы пула потоков...")
         executor.shutdown(wait=True)
         logger.info(f"{LOGGER_PREFIX} Пул потоков успешно остановлен")
 
+    # Очереди сообщений останавливаются после пула: заказы в работе успевают поставить в них номера
+    if validation_executor:
+        validation_executor.shutdown(wait=False)
+
+    if buyer_outbox:
+        buyer_outbox.stop()
+
+    if admin_notifier:
+        admin_notifier.stop()
+
+    metrics.stop()
+    try:
+        metrics.export(METRICS_PATH)
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Ошибка при выгрузке метрик в {METRICS_PATH}: {e}")
+
+    if order_journal:
+        order_journal.stop()
+
+    if lzt_client:
+        lzt_client.close()
+
+    if order_store:
+        order_store.close()
+
+    if profit_ledger:
+        profit_ledger.close()
+
+    if config_store:
+        config_store.flush()
+
 
 BIND_TO_PRE_INIT = [init_commands]
 BIND_TO_NEW_MESSAGE = [handle_plus_message]
@@ -0,0 +1,418 @@
+"""
+Офлайн-бенчмарк конвейера заказов плагина.
+
+Прогоняет синтетические заказы через handle_new_order и запросы кодов через handle_plus_message
+с поддельным Cardinal и локальной заглушкой API LZT Market. Деньги и реальные покупатели не нужны.
+
+Запуск из корня репозитория (нужны зависимости плагина: requests, telebot, FunPayAPI):
+
+    python bench/bench_pipeline.py --orders 200 --latency 80 --sold-out 0.3 --retry 0.1
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+COUNTRY_CODE = "ID"
+COUNTRY_PREFIX = "62"
+BASE_ITEM_ID = 1000000
+
+
+class FakeLztMarket:
+    """Заглушка API LZT Market с настраиваемой задержкой, долей проданных лотов и ответов retry_request"""
+
+    def __init__(self, latency=0.05, jitter=0.2, sold_out=0.2, retry=0.05, page_size=20, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.sold_out = sold_out
+        self.retry = retry
+        self.page_size = page_size
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_item_id = BASE_ITEM_ID
+        self._sold = set()
+        self._unavailable = set()
+        self.requests = {}
+        self.server = None
+
+    def _sleep(self):
+        with self._lock:
+            delay = self.latency * (1 + self._random.uniform(-self.jitter, self.jitter))
+        time.sleep(max(0.0, delay))
+
+    def _roll(self, probability):
+        with self._lock:
+            return self._random.random() < probability
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def _new_items(self, count, pmin, pmax):
+        items = []
+        with self._lock:
+            for _ in range(count):
+                item_id = self._next_item_id
+                self._next_item_id += 1
+                if self._random.random() < self.sold_out:
+                    self._unavailable.add(item_id)
+                items.append({
+                    "item_id": item_id,
+                    "price": round(self._random.uniform(pmin, pmax), 2),
+                    "item_state": "active",
+                    "country": COUNTRY_CODE
+                })
+        items.sort(key=lambda item: item["price"])
+        return items
+
+    def search(self, query):
+        pmin = float(query.get("pmin", ["1"])[0])
+        pmax = float(query.get("pmax", ["100"])[0])
+        return 200, {"items": self._new_items(self.page_size, pmin, pmax)}
+
+    def item(self, item_id):
+        with self._lock:
+            state = "closed" if item_id in self._sold or item_id in self._unavailable else "active"
+        return 200, {"item": {"item_id": item_id, "item_state": state}}
+
+    def fast_buy(self, item_id):
+        if self._roll(self.retry):
+            return 400, {"errors": ["retry_request"]}
+        with self._lock:
+            if item_id in self._sold or item_id in self._unavailable:
+                return 400, {"errors": ["Аккаунт продан"]}
+            self._sold.add(item_id)
+        phone = f"{COUNTRY_PREFIX}{item_id:010d}"
+        return 200, {"item": {
+            "item_id": item_id,
+            "price": 10,
+            "telegram_id": item_id,
+            "telegram_phone": phone,
+            "telegram_username": f"user{item_id}",
+            "loginData": {"login": phone, "password": ""}
+        }}
+
+    def login_code(self, item_id):
+        if self._roll(self.retry):
+            return 400, {"errors": ["retry_request"]}
+        return 200, {"codes": [{"code": f"{item_id % 100000:05d}"}]}
+
+    def route(self, method, path, query):
+        parts = [part for part in path.split("/") if part]
+        if method == "GET" and parts == ["telegram"]:
+            return "search", self.search(query)
+        if len(parts) == 2 and parts[1] == "fast-buy" and method == "POST":
+            return "fast_buy", self.fast_buy(int(parts[0]))
+        if len(parts) == 2 and parts[1] == "telegram-login-code" and method == "GET":
+            return "login_code", self.login_code(int(parts[0]))
+        if len(parts) == 1 and parts[0].isdigit() and method == "GET":
+            return "item", self.item(int(parts[0]))
+        return "unknown", (404, {"errors": ["not found"]})
+
+    def start(self):
+        market = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def _handle(self, method):
+                url = urlparse(self.path)
+                market._sleep()
+                endpoint, (status, payload) = market.route(method, url.path, parse_qs(url.query))
+                market._count(endpoint)
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class FakeBot:
+    """Telegram-бот, который принимает регистрацию обработчиков и отбрасывает сообщения"""
+
+    def __init__(self):
+        self.callback_query_handlers = []
+        self.sent = 0
+
+    def message_handler(self, *args, **kwargs):
+        return lambda handler: handler
+
+    def callback_query_handler(self, *args, **kwargs):
+        return lambda handler: handler
+
+    def send_message(self, *args, **kwargs):
+        self.sent += 1
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class FakeAccount:
+    """Аккаунт FunPay: фиксирует время сообщений покупателям и отдаёт заказы из памяти"""
+
+    def __init__(self, recorder):
+        self._recorder = recorder
+        self._orders = {}
+        self.refunds = 0
+
+    def add_order(self, order):
+        self._orders[order.id] = order
+
+    def get(self):
+        return self
+
+    def get_sells(self, start_from=None, **kwargs):
+        return None, []
+
+    def get_order(self, order_id):
+        order = self._orders[order_id]
+        return SimpleNamespace(id=order_id, full_description=order.description, sum=order.price, amount=1)
+
+    def get_chat_by_name(self, username, make_request=False):
+        return SimpleNamespace(id=f"chat-{username}")
+
+    def send_message(self, chat_id, text, chat_name=None):
+        self._recorder.on_message(chat_name, text)
+
+    def refund(self, order_id):
+        self.refunds += 1
+
+
+class FakeCardinal:
+    def __init__(self, recorder):
+        self.account = FakeAccount(recorder)
+        self.telegram = SimpleNamespace(bot=FakeBot())
+
+
+class Recorder:
+    """Время от поступления заказа до выдачи номера и от запроса кода до его доставки"""
+
+    PHONE_PATTERN = re.compile(r'Телефон:\s*(\d+)')
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.order_started = {}
+        self.order_done = {}
+        self.phones = {}
+        self.code_started = {}
+        self.code_done = {}
+        self.failed_orders = set()
+        self.failed_codes = set()
+
+    def start_order(self, buyer):
+        with self._cond:
+            self.order_started[buyer] = time.monotonic()
+
+    def start_code(self, buyer):
+        with self._cond:
+            self.code_started[buyer] = time.monotonic()
+
+    def on_message(self, buyer, text):
+        now = time.monotonic()
+        with self._cond:
+            if buyer in self.code_started and buyer not in self.code_done:
+                if text.startswith("🔄"):
+                    return
+                self.code_done[buyer] = now
+                if not text.startswith("✅"):
+                    self.failed_codes.add(buyer)
+            elif buyer in self.order_started and buyer not in self.order_done:
+                if text.startswith("⏳"):
+                    return
+                self.order_done[buyer] = now
+                match = self.PHONE_PATTERN.search(text)
+                if match:
+                    self.phones[buyer] = match.group(1)
+                else:
+                    self.failed_orders.add(buyer)
+            self._cond.notify_all()
+
+    def wait(self, started, done, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(done) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    @staticmethod
+    def latencies(started, done):
+        return sorted(done[key] - started[key] for key in done if key in started)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def format_latencies(title, values, elapsed):
+    throughput = len(values) / elapsed * 60 if elapsed else 0.0
+    return (
+        f"{title}: {len(values)} за {elapsed:.2f} сек. ({throughput:.1f}/мин), "
+        f"p50 {percentile(values, 0.5) * 1000:.0f} мс, p95 {percentile(values, 0.95) * 1000:.0f} мс, "
+        f"p99 {percentile(values, 0.99) * 1000:.0f} мс, макс. {(values[-1] if values else 0) * 1000:.0f} мс"
+    )
+
+
+def write_config(args):
+    os.makedirs("storage/tg", exist_ok=True)
+    config = {
+        "countries": {COUNTRY_CODE: {"name": "Bench", "min_price": 1, "max_price": 100}},
+        "administrators": [1],
+        "auto_returns": args.auto_returns,
+        "lolz_token": "bench",
+        "origins": ["personal"],
+        "prefetch_enabled": args.prefetch,
+        "hold_on_lzt_outage": args.hold
+    }
+    if not args.rate_limits:
+        # Заглушка лимитов не вводит, поэтому по умолчанию замеряется сам конвейер
+        unlimited = {"per_minute": 1000000, "burst": 1000}
+        config["rate_limits"] = {name: dict(unlimited) for name in ("search", "fast_buy", "login_code", "item")}
+    with open("storage/tg/config.json", "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=4)
+
+
+def run(args):
+    import autoressel
+
+    market = FakeLztMarket(args.latency / 1000, sold_out=args.sold_out, retry=args.retry,
+                           page_size=args.page_size, seed=args.seed)
+    base_url = market.start()
+
+    recorder = Recorder()
+    cardinal = FakeCardinal(recorder)
+
+    write_config(args)
+    autoressel.init_commands(cardinal)
+    autoressel.lzt_client.base_url = base_url
+
+    orders = []
+    for number in range(args.orders):
+        buyer = f"buyer{number}"
+        order = SimpleNamespace(
+            id=f"BENCH{number:06d}",
+            description=f"Telegram аккаунт, tg: {COUNTRY_CODE}{number}",
+            buyer_username=buyer,
+            price=50,
+            amount=1
+        )
+        cardinal.account.add_order(order)
+        orders.append(SimpleNamespace(order=order))
+
+    interval = 1 / args.rate if args.rate > 0 else 0
+    started = time.monotonic()
+    for event in orders:
+        recorder.start_order(event.order.buyer_username)
+        autoressel.handle_new_order(cardinal, event)
+        if interval:
+            time.sleep(interval)
+
+    completed = recorder.wait(recorder.order_started, recorder.order_done, len(orders), args.timeout)
+    orders_elapsed = time.monotonic() - started
+    order_latencies = Recorder.latencies(recorder.order_started, recorder.order_done)
+
+    code_latencies = []
+    codes_elapsed = 0.0
+    if args.codes:
+        code_buyers = list(recorder.phones.items())
+        started = time.monotonic()
+        for buyer, phone in code_buyers:
+            recorder.start_code(buyer)
+            message = SimpleNamespace(text=f"cd {phone}", chat_id=f"chat-{buyer}", chat_name=buyer, author=buyer)
+            autoressel.handle_plus_message(cardinal, SimpleNamespace(message=message))
+        recorder.wait(recorder.code_started, recorder.code_done, len(code_buyers), args.timeout)
+        codes_elapsed = time.monotonic() - started
+        code_latencies = Recorder.latencies(recorder.code_started, recorder.code_done)
+
+    print(f"Заглушка LZT: задержка {args.latency} мс, продано {args.sold_out:.0%}, retry_request {args.retry:.0%}")
+    print(format_latencies("Время до номера", order_latencies, orders_elapsed))
+    print(f"Выдано номеров: {len(recorder.phones)}, без номера: {len(recorder.failed_orders)}, "
+          f"возвратов: {cardinal.account.refunds}" + ("" if completed else ", не дождались части заказов"))
+    if args.codes:
+        print(format_latencies("Время до кода", code_latencies, codes_elapsed))
+        print(f"Ошибок выдачи кода: {len(recorder.failed_codes)}")
+    print(f"Запросы к заглушке: {json.dumps(market.requests, ensure_ascii=False, sort_keys=True)}")
+
+    if args.stages:
+        print("\nЭтапы (p50 / p95 / p99, мс):")
+        for stage, data in autoressel.metrics.snapshot().items():
+            q = data["quantiles"]
+            print(f"  {stage}: {q[0.5] * 1000:.0f} / {q[0.95] * 1000:.0f} / {q[0.99] * 1000:.0f}, "
+                  f"всего {data['count']}, ошибок {data['error_rate'] * 100:.1f}%")
+
+    autoressel.shutdown()
+    market.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк конвейера заказов")
+    parser.add_argument("--orders", type=int, default=100, help="число синтетических заказов")
+    parser.add_argument("--rate", type=float, default=0, help="заказов в секунду, 0 - все сразу")
+    parser.add_argument("--latency", type=float, default=50, help="задержка ответа заглушки LZT, мс")
+    parser.add_argument("--sold-out", type=float, default=0.2, help="доля уже проданных лотов в выдаче поиска")
+    parser.add_argument("--retry", type=float, default=0.05, help="доля ответов retry_request")
+    parser.add_argument("--page-size", type=int, default=20, help="число лотов в ответе поиска")
+    parser.add_argument("--seed", type=int, default=None, help="seed генератора для воспроизводимости")
+    parser.add_argument("--timeout", type=float, default=300, help="максимальное ожидание завершения, сек.")
+    parser.add_argument("--no-codes", dest="codes", action="store_false", help="не замерять выдачу кодов")
+    parser.add_argument("--rate-limits", action="store_true", help="оставить лимиты запросов по умолчанию")
+    parser.add_argument("--prefetch", action="store_true", help="включить прогрев кэша аккаунтов")
+    parser.add_argument("--hold", action="store_true", help="откладывать заказы при недоступности LZT")
+    parser.add_argument("--no-auto-returns", dest="auto_returns", action="store_false", help="выключить автовозврат")
+    parser.add_argument("--stages", action="store_true", help="вывести задержки по этапам")
+    parser.add_argument("--keep-dir", action="store_true", help="не удалять рабочий каталог с данными прогона")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="tg_bench_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        run(args)
+    finally:
+        os.chdir(cwd)
+        if args.keep_dir:
+            print(f"Данные прогона: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()